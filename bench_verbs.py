@@ -0,0 +1,63 @@
+# Agreement and speed of the verb backends of main.py, on every "could/should/would have X" and "going to X" of a corpus
+# py bench_verbs.py                 (all of wheel/*.txt)
+# py bench_verbs.py book.txt --limit 2000
+
+import argparse
+from collections import Counter
+import glob
+import os
+import time
+
+import main
+
+
+def collect_candidates(paths, limit=None):
+    """(word, sentence) for every verb check add_double_word_reductions makes on the lines of the files"""
+    candidates = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                line = line.strip()
+                for word in main.verb_candidates(line):
+                    candidates.append((word, line))
+                    if limit and len(candidates) >= limit:
+                        return candidates
+    return candidates
+
+
+def run_backend(backend, candidates):
+    main.verb_backend = backend
+    start = time.perf_counter()
+    if backend == "nltk":
+        main.tag_sentences(sentence for _, sentence in candidates)
+    answers = [main.is_verb_in_sentence(word, sentence) for word, sentence in candidates]
+    return answers, time.perf_counter() - start
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="*", help="Text files. Defaults to the wheel corpus")
+    parser.add_argument("--limit", type=int, default=None, help="Stop after this many verb checks")
+    args = parser.parse_args()
+    paths = args.paths or sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "wheel", "*.txt")))
+
+    candidates = collect_candidates(paths, args.limit)
+    print(f"{len(candidates)} verb checks in {len(paths)} files")
+    lexicon, lexicon_time = run_backend("lexicon", candidates)
+    print(f"lexicon: {lexicon_time:.3f}s, {sum(lexicon)} verbs")
+    try:
+        nltk_answers, nltk_time = run_backend("nltk", candidates)
+    except LookupError:
+        print("nltk: tagger data missing, can't compare. Run nltk.download(\"averaged_perceptron_tagger_eng\") and nltk.download(\"punkt_tab\")")
+        return
+    print(f"nltk: {nltk_time:.3f}s, {sum(nltk_answers)} verbs")
+
+    disagreements = Counter((word.lower(), lex) for (word, _), lex, tag in zip(candidates, lexicon, nltk_answers) if lex != tag)
+    agreement = 1 - sum(disagreements.values()) / max(1, len(candidates))
+    print(f"agreement: {agreement:.2%}")
+    for (word, lex), count in disagreements.most_common(30):
+        print(f"  {word!r}: lexicon says {'verb' if lex else 'not a verb'} ({count}x)")
+
+
+if __name__ == "__main__":
+    main_bench()
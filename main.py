@@ -1,30 +1,177 @@
 # Rebuild flite: cd flite; make clean && make -j$(nproc)
 
 import argparse
-from concurrent.futures import ThreadPoolExecutor
+from array import array
+import asyncio
+import atexit
+from collections import ChainMap, Counter, deque
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import heapq
+import inspect
+import itertools
 from io import TextIOWrapper
 import html as html_module
 import json
 import logging
+import marshal
+import math
 import re
+import sqlite3
 import string
 import subprocess
 import sys
-from typing import Dict, List, Optional, Tuple
+import tempfile
+import threading
+import time
+from typing import Deque, Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple, TypeVar, Union
 import unicodedata
 import os
-import nltk
-from nltk import pos_tag, word_tokenize
-
-# Download required NLTK resources if not already available
-nltk.download('averaged_perceptron_tagger', quiet=True)
-nltk.download('punkt', quiet=True)
-nltk.download('punkt_tab', quiet=True)
-nltk.download('averaged_perceptron_tagger_eng', quiet=True)
+# NLTK is only needed by --verb-backend nltk, so it's imported, and its data found or downloaded, on first use.
+# NLTK before NLTK_NEW_DATA_VERSION loads the first resource of each pair, later versions the second
+NLTK_NEW_DATA_VERSION = (3, 9)
+NLTK_RESOURCES = [(("averaged_perceptron_tagger", "taggers/averaged_perceptron_tagger"),
+                   ("averaged_perceptron_tagger_eng", "taggers/averaged_perceptron_tagger_eng")),
+                  (("punkt", "tokenizers/punkt"), ("punkt_tab", "tokenizers/punkt_tab"))]
+# --nltk-offline: never download, fail at once if the data isn't installed
+nltk_offline = False
+_nltk = None
+
+def _nltk_version(nltk) -> Tuple[int, ...]:
+    return tuple(int(part) for part in re.findall(r"\d+", nltk.__version__)[:2])
+
+def _load_nltk():
+    global _nltk
+    if _nltk is None:
+        import nltk
+        new_data = _nltk_version(nltk) >= NLTK_NEW_DATA_VERSION
+        for group in NLTK_RESOURCES:
+            name, path = group[new_data]
+            try:
+                nltk.data.find(path)
+                continue
+            except LookupError:
+                pass
+            if nltk_offline:
+                raise LookupError(f"NLTK data {name} is not installed and --nltk-offline is set. "
+                                  f"Install it with: python -m nltk.downloader {name}")
+            nltk.download(name, quiet=True)
+        _nltk = nltk
+    return _nltk
+
+def word_tokenize(sentence: str) -> List[str]:
+    return _load_nltk().word_tokenize(sentence)
+
+def pos_tag_sents(sentences: List[List[str]]) -> List[List[Tuple[str, str]]]:
+    return _load_nltk().pos_tag_sents(sentences)
+
+# --rule-stats: how often every rule fired this run. None when not asked for. Every counting site checks
+# `__debug__ and rule_stats is not None` itself, so python -O compiles out the key building along with the count.
+# Documents run the rules on several threads and Counter updates aren't atomic, so the counts go through _count
+rule_stats: Optional["Counter[str]"] = None
+_rule_stats_lock = threading.Lock()
+
+def _count(rule: str, hits: int = 1):
+    with _rule_stats_lock:
+        rule_stats[rule] += hits
+
+def _count_all(hits: Mapping[str, int]):
+    with _rule_stats_lock:
+        rule_stats.update(hits)
+
+# Verb detection for double_word_with_verb. "lexicon" (default) looks the word up in VERB_WORDS and falls back to
+# VERB_SUFFIXES, "nltk" runs the perceptron tagger on the whole sentence. Compare the two with bench_verbs.py
+VERB_BACKENDS = ("lexicon", "nltk")
+verb_backend = "lexicon"
+
+# Common verbs, and the irregular past forms that follow "could have" (or wrongly do). Regular ones are caught by suffix
+VERB_WORDS = frozenset("""
+    be do have go get make say know think take see come want look use find give tell work call try ask need feel become
+    leave put mean keep let begin seem help talk turn start show hear play run move like live believe hold bring happen
+    write provide sit stand lose pay meet include continue set learn change lead understand watch follow stop create speak
+    read allow add spend grow open walk win offer remember love consider appear buy wait serve die send expect build stay
+    fall cut reach kill remain suggest raise pass sell require report decide pull return explain hope develop carry break
+    receive agree support hit produce eat cover catch draw choose cause point listen realize close thank drop push throw
+    fight wish sleep marry teach wear ride kiss laugh smile cry shout scream fly swim sing dance jump climb drive shoot
+    steal hide burn wash dress touch hurt save rest enjoy face visit attack destroy protect rescue escape survive travel
+    wonder forget forgive pray bow bet tie fit lie lay rise shake strike swear tear bite blow freeze bleed breed feed flee
+    hang seek shine shut sink slide spin spit spread spring sting sweep swing weave weep wind bend bind bear deal dig dream
+    fling grind kneel lean leap light quit sew shrink slay smell sow speed spill upset withdraw wake answer argue arrange
+    arrive attend avoid behave belong blame boil borrow bother breathe brush chase cheat check chew clean collect compare
+    complain complete confess connect convince cook count crawl cross crush deliver depend describe deserve disappear
+    discover divide doubt drag drown earn embrace end enter examine exist fail fetch fill finish fix float flow fold force
+    frighten gather glance grab greet grin guard guess handle hate heal hesitate hunt hurry ignore imagine improve inform
+    insist interrupt introduce invite join judge kick knock land lift lock manage mark measure mention miss mix murder nod
+    notice obey observe obtain occur order own pack paint pause perform pick plan plant pour prefer prepare pretend prevent
+    promise prove punish reply reveal rub rush sail scratch search settle share shiver sigh slip snap spare squeeze stare
+    step study succeed suffer suit surprise suspect swallow taste tempt tend trade trap treat tremble trick trouble trust
+    warn waste whisper wipe worry wrap yell accept access abandon afford channel explode vomit stab strangle pound burst
+    risk pop stick starve outrun hurl
+    was were did went came saw took gave knew thought told felt
+    been done had made known said gone seen taken given sent found gotten brought chosen held heard stood meant fallen
+    sworn kept broken worn spoken ridden laid drawn frozen begun understood taught sat slept shown thrown spent lost led
+    fought caught hidden bitten woven won stuck struck shaken risen lain grown fled fed bought written eaten driven
+    forgotten forgiven beaten torn born borne flown sung swum drunk sunk shrunk sprung stung swung hung dug spun spat slid
+    lit met paid sold sought shot split stolen swept wept woken bound ground knelt leapt sewn sown mistaken overcome
+    withdrawn awoken arisen blown flung clung strode left dealt
+""".split())
+# "-ed" words that aren't verbs
+NON_VERB_WORDS = frozenset("bed red hundred sacred naked wicked seed greed reed weed steed creed deed indeed kindred rugged ragged "
+                           "wretched shred sled tired aged beloved crooked".split())
+VERB_SUFFIXES = ("ed", "ize", "ify")
+
+def is_verb_word(word: str) -> bool:
+    word = word.strip(string.punctuation + "“”‘’").lower()
+    if word in VERB_WORDS:
+        return True
+    if word in NON_VERB_WORDS:
+        return False
+    return len(word) > 3 and word.endswith(VERB_SUFFIXES)
+
+# Tags of every sentence tagged so far. The tagger is slow and a sentence can hold several verb conditioned reductions.
+# Documents are tagged from several threads, so the memo is only changed under _pos_tags_lock
+POS_TAG_CACHE_SIZE = 10000
+_pos_tags: Dict[str, List[Tuple[str, str]]] = {}
+_pos_tags_lock = threading.Lock()
+
+def tag_sentences(sentences: Iterable[str]) -> Dict[str, List[Tuple[str, str]]]:
+    """Tags all the sentences not tagged yet with one pos_tag_sents call and returns the tags of every sentence"""
+    tags = {}
+    new = []
+    for sentence in dict.fromkeys(sentences):
+        tagged = _pos_tags.get(sentence)
+        if tagged is None:
+            new.append(sentence)
+        else:
+            tags[sentence] = tagged
+    if new:
+        tags.update(zip(new, pos_tag_sents([word_tokenize(sentence) for sentence in new])))
+        with _pos_tags_lock:
+            if len(_pos_tags) + len(new) > POS_TAG_CACHE_SIZE:
+                _pos_tags.clear()
+            _pos_tags.update((sentence, tags[sentence]) for sentence in new)
+    return tags
+
+def verb_candidates(sentence: str) -> List[str]:
+    """The words add_double_word_reductions will ask is_verb_in_sentence about"""
+    words = sentence.lower().split(" ")
+    candidates = []
+    for i in range(len(words) - 2):
+        for second, _, needs_verb in _double_word_lookup.get(words[i], ()):
+            if needs_verb and words[i+1] == second and words[i+2] != "" and not (second in ("will", "have", "has") and words[i+2] == "not"):
+                candidates.append(words[i+2])
+    return candidates
+
+def needs_pos_tags(sentence: str) -> bool:
+    return verb_backend == "nltk" and bool(verb_candidates(sentence))
 
 def is_verb_in_sentence(word, sentence):
-    tokens = word_tokenize(sentence)
-    tagged_words = pos_tag(tokens)
+    if verb_backend == "lexicon":
+        return is_verb_word(word)
+    tagged_words = _pos_tags.get(sentence)
+    if tagged_words is None:
+        tagged_words = tag_sentences([sentence])[sentence]
     word_lower = word.lower()
     for tagged_word, pos in tagged_words:
         if tagged_word.lower() == word_lower:
@@ -57,16 +204,60 @@ double_word_reductions = { "do you": "dju", "what did": "wʌd", # These are ofte
 double_word_with_verb = {"could have": "cʊdə", "should have": "ʃʊdə", "would have": "wʊdə", "going to": "gɑnə"}
 # all noun+will can be reduced to x'll, but too hard for me to implement
 
-_double_word_lookup: Dict[str, List[Tuple[str, str, bool]]] = {}
-for _orig, _changed in double_word_reductions.items():
-    _first, _second = _orig.split(" ")
-    _double_word_lookup.setdefault(_first, []).append((_second, _changed, False))
-for _orig, _changed in double_word_with_verb.items():
-    _first, _second = _orig.split(" ")
-    _double_word_lookup.setdefault(_first, []).append((_second, _changed, True))
+def _build_double_word_lookup() -> Dict[str, List[Tuple[str, str, bool]]]:
+    lookup: Dict[str, List[Tuple[str, str, bool]]] = {}
+    for orig, changed in double_word_reductions.items():
+        first, second = orig.split(" ")
+        lookup.setdefault(first, []).append((second, changed, False))
+    for orig, changed in double_word_with_verb.items():
+        first, second = orig.split(" ")
+        lookup.setdefault(first, []).append((second, changed, True))
+    return lookup
+
+_double_word_lookup = _build_double_word_lookup()
+
+class RuleTable(dict):
+    """A rule dict that counts its changes, so what is compiled from it can tell when it is stale"""
+    __slots__ = ("version",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = 0
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.version += 1
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.version += 1
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.version += 1
+
+    def setdefault(self, key, default=None):
+        self.version += 1
+        return super().setdefault(key, default)
+
+    def pop(self, *args):
+        self.version += 1
+        return super().pop(*args)
+
+    def popitem(self):
+        self.version += 1
+        return super().popitem()
+
+    def clear(self):
+        super().clear()
+        self.version += 1
 
 # Most of those are not wrong, we just prefer it like this. These will be replced if appear in a word (good for plural and such):
-improved_pronounciations = {
+improved_pronounciations = RuleTable({
     "fæməli":"fæmli",
     "kʌmfɝtəbəl":"kʌmftɝbəl",
     "feɪvɝɪt":"feɪvɹɪt",
@@ -91,7 +282,212 @@ improved_pronounciations = {
     # words specifically for certain books:
     "waɪtɪˈkloʊks": "waɪtˈkloʊks",
     "waɪtɪˈkloʊk": "waɪtˈkloʊk",
-}
+})
+
+class AhoCorasick:
+    """Substring rewrites matched with one scan of a line, however many there are. Like looping over the rewrites with
+    `in`, each word gets the first rewrite (in table order) found anywhere in it"""
+    @classmethod
+    def from_tables(cls, tables: tuple) -> "AhoCorasick":
+        """Rebuilds a matcher from its tables(), without redoing the construction"""
+        matcher = cls.__new__(cls)
+        matcher.patterns, matcher.replacements, matcher.goto, matcher.fail, matcher.best = tables
+        matcher.no_match = len(matcher.patterns)
+        return matcher
+
+    def tables(self) -> tuple:
+        return self.patterns, self.replacements, self.goto, self.fail, self.best
+
+    def __init__(self, rewrites: Mapping[str, str]):
+        self.patterns = list(rewrites)
+        self.replacements = list(rewrites.values())
+        self.no_match = len(self.patterns)
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail = [0]
+        # lowest pattern index ending at a state, its own or through its fail links
+        self.best = [self.no_match]
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for ch in pattern:
+                if ch not in self.goto[state]:
+                    self.goto[state][ch] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.best.append(self.no_match)
+                state = self.goto[state][ch]
+            self.best[state] = min(self.best[state], index)
+        states = deque(self.goto[0].values())
+        for state in states:
+            self.best[state] = min(self.best[state], self.best[0])
+        while states:
+            state = states.popleft()
+            for ch, next_state in self.goto[state].items():
+                fail = self.fail[state]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(ch, 0)
+                self.best[next_state] = min(self.best[next_state], self.best[self.fail[next_state]])
+                states.append(next_state)
+
+    def first_matches(self, text: str) -> List[int]:
+        """For every word of text.split(" "), the index of its rewrite, or no_match"""
+        goto, fail, best = self.goto, self.fail, self.best
+        found = []
+        state = 0
+        first = best[0]
+        for ch in text:
+            if ch == " ":
+                found.append(first)
+                state = 0
+                first = best[0]
+                continue
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if best[state] < first:
+                first = best[state]
+        found.append(first)
+        return found
+
+    def rewrite(self, word: str, index: int) -> str:
+        if index == self.no_match:
+            return word
+        return word.replace(self.patterns[index], self.replacements[index])
+
+_improved_matcher_cache: Optional[Tuple[Dict[str, str], object, AhoCorasick]] = None
+
+def _table_state(table: Dict[str, str]) -> object:
+    # a RuleTable tells its changes cheaply, a plain dict has to be compared entry by entry
+    return table.version if isinstance(table, RuleTable) else tuple(table.items())
+
+def _improved_matcher() -> AhoCorasick:
+    """AhoCorasick of improved_pronounciations, rebuilt when the table is replaced or changed"""
+    global _improved_matcher_cache
+    if _improved_matcher_cache is None or _improved_matcher_cache[0] is not improved_pronounciations \
+            or _improved_matcher_cache[1] != _table_state(improved_pronounciations):
+        _improved_matcher_cache = (improved_pronounciations, _table_state(improved_pronounciations), AhoCorasick(improved_pronounciations))
+    return _improved_matcher_cache[2]
+
+# IPA words handle_t_d leaves alone (names flite spells with a t/d we don't want flapped). --lexicon packs add more
+t_d_skip_words = {"ɹænd", "ɹændz", "mæt"}
+
+# Rule packs: JSON files holding any of the RULE_TABLES, e.g. {"improved_pronounciations": {"ˈwɛlə": "ˈwilə"}}.
+# --rules layers them over the built in tables above, in order, and an entry replaces the one with the same key.
+# The compiled tables (double word lookup and the AhoCorasick automaton) are cached in _rule_cache_dir
+RULE_TABLES = ("normal_reductions", "h_reduction", "double_word_reductions", "double_word_with_verb", "improved_pronounciations")
+_rule_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__rulecache__')
+
+def load_rule_pack(path: str) -> Dict[str, Dict[str, str]]:
+    with open(path, "r", encoding="utf-8") as f:
+        pack = json.load(f)
+    if not isinstance(pack, dict) or set(pack) - set(RULE_TABLES):
+        raise ValueError(f"{path}: a rule pack is a JSON object with some of the tables {', '.join(RULE_TABLES)}")
+    for name, table in pack.items():
+        if not isinstance(table, dict) or not all(isinstance(k, str) and isinstance(v, str) for k, v in table.items()):
+            raise ValueError(f"{path}: {name} must map strings to strings")
+        if name in ("double_word_reductions", "double_word_with_verb") and any(len(key.split(" ")) != 2 for key in table):
+            raise ValueError(f"{path}: {name} keys must be two words")
+    return pack
+
+def use_rule_packs(paths: List[str]):
+    """Layers the rule packs over the current tables and compiles the result"""
+    global normal_reductions, h_reduction, double_word_reductions, double_word_with_verb, improved_pronounciations
+    tables = [dict(normal_reductions), dict(h_reduction), dict(double_word_reductions), dict(double_word_with_verb),
+              RuleTable(improved_pronounciations)]
+    for path in paths:
+        pack = load_rule_pack(path)
+        for name, table in zip(RULE_TABLES, tables):
+            table.update(pack.get(name, {}))
+    normal_reductions, h_reduction, double_word_reductions, double_word_with_verb, improved_pronounciations = tables
+    _compile_rules()
+
+def _compile_rules():
+    """Builds _double_word_lookup and the improved_pronounciations matcher, or loads them from the cache"""
+    global _double_word_lookup, _improved_matcher_cache
+    digest = hashlib.sha1(json.dumps([marshal.version, double_word_reductions, double_word_with_verb, improved_pronounciations],
+                                     ensure_ascii=False).encode('utf-8'))
+    cache_path = os.path.join(_rule_cache_dir, digest.hexdigest() + ".marshal")
+    try:
+        with open(cache_path, "rb") as f:
+            lookup, matcher_tables = marshal.load(f)
+        matcher = AhoCorasick.from_tables(matcher_tables)
+    except (OSError, EOFError, ValueError, TypeError):
+        lookup = _build_double_word_lookup()
+        matcher = AhoCorasick(improved_pronounciations)
+        try:
+            os.makedirs(_rule_cache_dir, exist_ok=True)
+            # workers compile the same packs at the same time, each writes its own file and the last replace wins
+            fd, tmp_path = tempfile.mkstemp(dir=_rule_cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    marshal.dump((lookup, matcher.tables()), f)
+                os.replace(tmp_path, cache_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        except OSError:
+            logging.warning('could not write the compiled rule cache.')
+    _double_word_lookup = lookup
+    _improved_matcher_cache = (improved_pronounciations, _table_state(improved_pronounciations), matcher)
+
+# Lexicon packs (--lexicon): proper noun fixes for one book or series, as a JSON object with any of
+#   "words": {"Egwene": "ɛˈɡwin"}  flite style pronunciation (stress marks kept) used instead of flite's for the word
+#   "ipa": {"waɪtɪˈkloʊks": "waɪtˈkloʊks"}  rewrites like improved_pronounciations, tried before the built in ones
+#   "t_d_skip": ["ɹænd"]  words for t_d_skip_words
+LEXICON_SECTIONS = ("words", "ipa", "t_d_skip")
+# Pronunciations from the "words" of all the lexicon packs, keyed by the lower case word
+book_words: Dict[str, str] = {}
+
+def load_lexicon_pack(path: str) -> Dict[str, object]:
+    with open(path, "r", encoding="utf-8") as f:
+        pack = json.load(f)
+    if not isinstance(pack, dict) or set(pack) - set(LEXICON_SECTIONS):
+        raise ValueError(f"{path}: a lexicon pack is a JSON object with some of {', '.join(LEXICON_SECTIONS)}")
+    for name in ("words", "ipa"):
+        table = pack.get(name, {})
+        if not isinstance(table, dict) or not all(isinstance(k, str) and isinstance(v, str) and v.strip() for k, v in table.items()):
+            raise ValueError(f"{path}: {name} must map strings to non empty strings")
+    if not all(isinstance(word, str) for word in pack.get("t_d_skip", [])):
+        raise ValueError(f"{path}: t_d_skip must be a list of strings")
+    if any(len(word.split()) != 1 for word in pack.get("words", {})):
+        raise ValueError(f"{path}: words must be single words")
+    return pack
+
+def use_lexicon_packs(paths: List[str]):
+    global book_words, improved_pronounciations, t_d_skip_words
+    words = dict(book_words)
+    ipa: Dict[str, str] = {}
+    skip = set(t_d_skip_words)
+    for path in paths:
+        pack = load_lexicon_pack(path)
+        words.update((word.lower(), pronunciation) for word, pronunciation in pack.get("words", {}).items())
+        # later packs first, like the later entries of `words` win
+        ipa = {**pack.get("ipa", {}), **ipa}
+        skip.update(pack.get("t_d_skip", []))
+    book_words, t_d_skip_words = words, skip
+    if ipa:
+        improved_pronounciations = RuleTable({**ipa, **{k: v for k, v in improved_pronounciations.items() if k not in ipa}})
+        _compile_rules()
+
+def _apply_book_words(text: str, raw_ipa: str) -> str:
+    """Puts the book_words pronunciations into flite's output for text. Left alone if flite's words don't line up with text"""
+    if not book_words:
+        return raw_ipa
+    tokens = text.split()
+    ipa_tokens = raw_ipa.split()
+    trailing = raw_ipa[len(raw_ipa.rstrip()):]
+    if len(tokens) != len(ipa_tokens) or " ".join(ipa_tokens) + trailing != raw_ipa:
+        return raw_ipa
+    for i, token in enumerate(tokens):
+        prefix, core, suffix = _split_word_token(token)
+        pronunciation = book_words.get(core.lower()) if core else None
+        if pronunciation is not None:
+            ipa_token = ipa_tokens[i]
+            if ipa_token.startswith(prefix) and ipa_token.endswith(suffix):
+                ipa_tokens[i] = prefix + pronunciation + suffix
+            else:
+                ipa_tokens[i] = pronunciation
+    return " ".join(ipa_tokens) + trailing
 
 def get_next_char(text: list, word_idx: int, letter_idx: int) -> str:
     word = text[word_idx]
@@ -117,6 +513,8 @@ def add_reductions_with_stress(ipa_text: str, original_text: str):
     # here we still have the stress sine, and t/d's weren't handled yet
     out_text = ipa_text.split(" ")
     original_arr = original_text.lower().split(" ")
+    matcher = _improved_matcher()
+    matches = matcher.first_matches(ipa_text)
     for i, word in enumerate(out_text):
         stripped = word.strip()
         next_char = get_next_char(out_text, i, len(word)-1)
@@ -125,19 +523,25 @@ def add_reductions_with_stress(ipa_text: str, original_text: str):
             # check if both next word starts with a consonant and prev word ends with one
             if prev_char != "" and prev_char != "" and prev_char in ipa_consonants and next_char in ipa_consonants:
                 out_text[i] = word.replace("ʌv",  "ə")
+                if __debug__ and rule_stats is not None:
+                    _count("ʌv")
             continue
         elif original_arr[i] in normal_reductions.keys() or original_arr[i] in h_reduction.keys():
             # validate that this is not the last word. last word in sentence don't get reduced
             if next_char != "":
                 if original_arr[i] in normal_reductions.keys():
                     out_text[i] = normal_reductions[original_arr[i]]
+                    if __debug__ and rule_stats is not None:
+                        _count("normal:" + original_arr[i])
                 elif prev_char != "" and prev_char in ipa_consonants:
                     # h reductions happend only after a consonant
                     out_text[i] = h_reduction[original_arr[i]]
-        for orig, changed in improved_pronounciations.items():
-            if orig in stripped:
-                out_text[i] = word.replace(orig, changed)
-                break
+                    if __debug__ and rule_stats is not None:
+                        _count("h:" + original_arr[i])
+        if matches[i] != matcher.no_match:
+            out_text[i] = matcher.rewrite(word, matches[i])
+            if __debug__ and rule_stats is not None:
+                _count("improved:" + matcher.patterns[matches[i]])
     return " ".join(out_text)
 
 def add_double_word_reductions(ipa_text: str, original_text: str):
@@ -156,11 +560,15 @@ def add_double_word_reductions(ipa_text: str, original_text: str):
                         continue
                     if needs_verb:
                         if not is_verb_in_sentence(original_arr[i+2], original_text):
+                            if __debug__ and rule_stats is not None:
+                                _count(f"verb_rejected:{original_word} {second}")
                             continue
 
                     out_arr[i - removed_words] = changed
                     del out_arr[i - removed_words + 1]
                     removed_words += 1
+                    if __debug__ and rule_stats is not None:
+                        _count(f"{'verb' if needs_verb else 'double'}:{original_word} {second}")
     return " ".join(out_arr)
 
 def handle_t_d(ipa_text: str):
@@ -174,9 +582,12 @@ def handle_t_d(ipa_text: str):
     # t/d between two consonants (r doesn't count) can be removed. t/d after n as well sometimes? identify, twenty, want, count, disappoint.
     #   not in into, entry, antique, intend, contain, intake, intonation (first syllable is unstressed in most these words. All except entry)
     # tr -> tʃɹ, dr - dʒɹ, tj -> tʃj, dj - dʒj
-    out_text = ipa_text.replace("tɹ", "tʃɹ").replace("dɹ", "dʒɹ").replace("tj", "tʃj").replace("dj", "dʒj").split(" ")
+    split_text = ipa_text.replace("tɹ", "tʃɹ").replace("dɹ", "dʒɹ").replace("tj", "tʃj").replace("dj", "dʒj")
+    if __debug__ and rule_stats is not None:
+        _count("affricate", len(split_text) - len(ipa_text))
+    out_text = split_text.split(" ")
     for i, word in enumerate(out_text):
-        if word in ("ɹænd", "ɹændz", "mæt"):
+        if word in t_d_skip_words:
             continue #names that annoyingly gets reduced and we want to skip
         out_word = word
         for letter_idx in range(1, len(out_word)): # Beggining of a word will have a true t/d, so start from 1
@@ -198,21 +609,257 @@ def handle_t_d(ipa_text: str):
                     continue
                 # drop t/d
                 out_word = out_word[:letter_idx] + out_word[letter_idx+1:]
+                if __debug__ and rule_stats is not None:
+                    _count("drop_n")
                 break
             if prev_letter in (ipa_vowels + "ɝɹ") and next_letter in (ipa_vowels + "ɝ"):
                 # between 2 vowels, flap t/d
                 out_word =  out_word[:letter_idx] + 'ɾ' + out_word[letter_idx+1:]
+                if __debug__ and rule_stats is not None:
+                    _count("flap")
                 break
             if prev_letter in (ipa_consonants) and prev_letter not in "ɝɹʃ":
                 if next_letter in (ipa_consonants) and next_letter not in "ɝɹʃ":
                     if prev_letter != next_letter:
                         # between two consonants, drop t/d
                         out_word = out_word[:letter_idx] + out_word[letter_idx+1:]
+                        if __debug__ and rule_stats is not None:
+                            _count("drop_consonant")
                         break
 
         out_text[i] = out_word
     return " ".join(out_text)
 
+# The same rules as add_reductions_with_stress -> add_double_word_reductions -> handle_t_d -> stress mark removal,
+# run in one pass over the words of a line. Each word is reduced when the word after it needs its left neighbour,
+# and gets its t/d handling once the word after it is reduced.
+_TD_PATTERN = re.compile("[td]")
+
+def _reduce_word(tokens: List[str], originals: List[str], matcher: AhoCorasick, match: int, i: int, prev_word: str) -> str:
+    """add_reductions_with_stress for tokens[i]. prev_word is the already reduced word before it, match the index of its improved pronunciation"""
+    word = tokens[i]
+    stripped = word.strip()
+    next_word = tokens[i + 1] if i + 1 < len(tokens) else ""
+    next_char = next_word[0] if next_word else ""
+    prev_char = prev_word[-1] if prev_word else ""
+    if stripped == "ʌv":
+        if prev_char != "" and prev_char in ipa_consonants and next_char in ipa_consonants:
+            if __debug__ and rule_stats is not None:
+                _count("ʌv")
+            return word.replace("ʌv", "ə")
+        return word
+    out = word
+    original = originals[i]
+    if (original in normal_reductions or original in h_reduction) and next_char != "":
+        if original in normal_reductions:
+            out = normal_reductions[original]
+            if __debug__ and rule_stats is not None:
+                _count("normal:" + original)
+        elif prev_char != "" and prev_char in ipa_consonants:
+            out = h_reduction[original]
+            if __debug__ and rule_stats is not None:
+                _count("h:" + original)
+    if match != matcher.no_match:
+        if __debug__ and rule_stats is not None:
+            _count("improved:" + matcher.patterns[match])
+        return matcher.rewrite(word, match)
+    return out
+
+def _double_word_plan(original_arr: List[str], original_text: str, count: bool = True) -> Optional[List[Union[int, str]]]:
+    """add_double_word_reductions as a list of word indexes and merged words. None if nothing merges.
+    count=False leaves rule_stats alone, for callers that only want the word alignment"""
+    items: Optional[List[Union[int, str]]] = None
+    removed_words = 0
+    for i, original_word in enumerate(original_arr):
+        if original_word not in _double_word_lookup:
+            continue
+        for second, changed, needs_verb in _double_word_lookup[original_word]:
+            if len(original_arr) > i + 1 and original_arr[i+1] == second and len(original_arr) > i + 2 and original_arr[i+2] != "":
+                if second in ("will", "have", "has") and original_arr[i+2] == "not":
+                    continue
+                if needs_verb and not is_verb_in_sentence(original_arr[i+2], original_text):
+                    if __debug__ and count and rule_stats is not None:
+                        _count(f"verb_rejected:{original_word} {second}")
+                    continue
+                if items is None:
+                    items = list(range(len(original_arr)))
+                items[i - removed_words] = changed
+                del items[i - removed_words + 1]
+                removed_words += 1
+                if __debug__ and count and rule_stats is not None:
+                    _count(f"{'verb' if needs_verb else 'double'}:{original_word} {second}")
+    return items
+
+def _split_t_d_clusters(word: str) -> str:
+    if "ɹ" in word or "j" in word:
+        split = word.replace("tɹ", "tʃɹ").replace("dɹ", "dʒɹ").replace("tj", "tʃj").replace("dj", "dʒj")
+        # every split adds one letter
+        if __debug__ and rule_stats is not None:
+            _count("affricate", len(split) - len(word))
+        return split
+    return word
+
+def _handle_word_t_d(word: str, next_char: str) -> str:
+    """handle_t_d for one word. next_char is the first letter of the word after it"""
+    if word in t_d_skip_words:
+        return word
+    for match in _TD_PATTERN.finditer(word, 1):
+        letter_idx = match.start()
+        prev_letter = word[letter_idx - 1]
+        if prev_letter == 'ˈ':
+            continue
+        next_letter = word[letter_idx + 1] if letter_idx + 1 < len(word) else next_char
+        if next_letter == "" or next_letter not in ipa_letters:
+            continue
+        if prev_letter == 'n' and next_letter != 'ʃ' and next_letter != 'ʒ' and prev_letter != next_letter:
+            if letter_idx != len(word) - 1 and next_letter in ipa_vowels + "ɝ":
+                continue
+            if __debug__ and rule_stats is not None:
+                _count("drop_n")
+            return word[:letter_idx] + word[letter_idx+1:]
+        if prev_letter in (ipa_vowels + "ɝɹ") and next_letter in (ipa_vowels + "ɝ"):
+            if __debug__ and rule_stats is not None:
+                _count("flap")
+            return word[:letter_idx] + 'ɾ' + word[letter_idx+1:]
+        if prev_letter in ipa_consonants and prev_letter not in "ɝɹʃ":
+            if next_letter in ipa_consonants and next_letter not in "ɝɹʃ" and prev_letter != next_letter:
+                if __debug__ and rule_stats is not None:
+                    _count("drop_consonant")
+                return word[:letter_idx] + word[letter_idx+1:]
+    return word
+
+def apply_rules_fused(ipa_text: str, original_text: str) -> Optional[str]:
+    """The whole rule chain in one pass. None when flite's words don't line up with original_text one to one"""
+    tokens = ipa_text.split(" ")
+    originals = original_text.lower().split(" ")
+    if len(tokens) != len(originals):
+        return None
+    items = _double_word_plan(originals, original_text) or range(len(tokens))
+    matcher = _improved_matcher()
+    matches = matcher.first_matches(ipa_text)
+    reduced: List[str] = []
+
+    def value(item: Union[int, str]) -> str:
+        if isinstance(item, str):
+            return _split_t_d_clusters(item)
+        while len(reduced) <= item:
+            i = len(reduced)
+            reduced.append(_reduce_word(tokens, originals, matcher, matches[i], i, reduced[-1] if reduced else ""))
+        return _split_t_d_clusters(reduced[item])
+
+    out = []
+    word = value(items[0])
+    for k in range(1, len(items) + 1):
+        next_word = value(items[k]) if k < len(items) else ""
+        out.append(_handle_word_t_d(word, next_word[0] if next_word else "").replace("ˈ", ""))
+        word = next_word
+    return " ".join(out)
+
+# handle_t_d over many lines at once with NumPy: the lines are one UTF-16 code array, letter classes are lookup
+# tables, and every t/d is judged by array operations. Only worth it for large batches
+TD_BATCH_MIN_LINES = 64
+np = None
+_numpy_checked = False
+
+def _numpy():
+    """numpy, or None if it isn't installed. Imported on first use, it's slow to import"""
+    global np, _numpy_checked
+    if not _numpy_checked:
+        _numpy_checked = True
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            np = None
+    return np
+_TD_SEP = "\x00"
+
+def _code_table(chars: str) -> "np.ndarray":
+    table = np.zeros(1 << 16, dtype=bool)
+    table[[ord(c) for c in chars]] = True
+    return table
+
+_td_tables: Optional[Dict[str, "np.ndarray"]] = None
+
+def _get_td_tables() -> Dict[str, "np.ndarray"]:
+    global _td_tables
+    if _td_tables is None:
+        _td_tables = {"letter": _code_table(ipa_letters), "vowel": _code_table(ipa_vowels + "ɝ"),
+                      "flap_prev": _code_table(ipa_vowels + "ɝɹ"),
+                      "drop_consonant": _code_table("".join(c for c in ipa_consonants if c not in "ɝɹʃ"))}
+    return _td_tables
+
+def _handle_t_d_numpy(lines: List[str]) -> List[str]:
+    tables = _get_td_tables()
+    t, d, space, sep = ord("t"), ord("d"), ord(" "), ord(_TD_SEP)
+    codes = np.frombuffer(_TD_SEP.join(lines).encode("utf-16-le"), dtype="<u2")
+    # tɹ -> tʃɹ, dɹ -> dʒɹ, tj -> tʃj, dj -> dʒj: insert ʃ/ʒ after those t/d
+    is_t_d = (codes == t) | (codes == d)
+    next_codes = np.append(codes[1:], sep)
+    affricate = is_t_d & ((next_codes == ord("ɹ")) | (next_codes == ord("j")))
+    if __debug__ and rule_stats is not None:
+        _count("affricate", int(affricate.sum()))
+    if affricate.any():
+        shift = np.cumsum(affricate)
+        positions = np.arange(len(codes)) + shift - affricate
+        grown = np.empty(len(codes) + int(shift[-1]), dtype="<u2")
+        grown[positions] = codes
+        grown[positions[affricate] + 1] = np.where(codes[affricate] == t, ord("ʃ"), ord("ʒ"))
+        codes = grown
+    n = len(codes)
+    padded = np.concatenate([codes, [sep, sep]]).astype("<u2")
+    is_sep = (padded == space) | (padded == sep)
+    word_id = np.cumsum(is_sep)[:n]
+    word_start = np.ones(n, dtype=bool)
+    word_start[1:] = is_sep[:n - 1]
+    # words handle_t_d leaves alone
+    skipped = np.zeros(int(word_id[-1]) + 1 if n else 1, dtype=bool)
+    word_end = is_sep[1:n + 1]
+    for skip_word in t_d_skip_words:
+        skip_codes = np.frombuffer(skip_word.encode("utf-16-le"), dtype="<u2")
+        starts = np.flatnonzero(word_start & ~is_sep[:n])
+        starts = starts[starts + len(skip_codes) <= n]
+        match = word_end[starts + len(skip_codes) - 1]
+        for k, code in enumerate(skip_codes):
+            match &= padded[starts + k] == code
+        skipped[word_id[starts[match]]] = True
+
+    pos = np.flatnonzero((codes == t) | (codes == d))
+    pos = pos[~word_start[pos] & ~skipped[word_id[pos]]]
+    prev = padded[pos - 1]
+    after = padded[pos + 1]
+    last_in_word = is_sep[pos + 1]
+    # the letter after a word's last letter is the next word's first one, or none at the end of the line
+    next_letter = np.where(last_in_word, padded[pos + 2], after)
+    empty = (last_in_word & (after == sep)) | (last_in_word & is_sep[pos + 2])
+    valid = (prev != ord("ˈ")) & ~empty & tables["letter"][next_letter]
+    after_n = (prev == ord("n")) & (next_letter != ord("ʃ")) & (next_letter != ord("ʒ")) & (next_letter != prev)
+    n_drop = after_n & ~(~last_in_word & tables["vowel"][next_letter])
+    flap = ~after_n & tables["flap_prev"][prev] & tables["vowel"][next_letter]
+    consonant_drop = (~after_n & ~flap & tables["drop_consonant"][prev] & tables["drop_consonant"][next_letter]
+                      & (prev != next_letter))
+    acting = valid & (n_drop | flap | consonant_drop)
+    pos, flap = pos[acting], flap[acting]
+    # only the first change of every word
+    first = np.ones(len(pos), dtype=bool)
+    first[1:] = word_id[pos[1:]] != word_id[pos[:-1]]
+    pos, flap = pos[first], flap[first]
+    if __debug__ and rule_stats is not None:
+        n_dropped = n_drop[acting][first]
+        _count_all({"flap": int(flap.sum()), "drop_n": int(n_dropped.sum()),
+                    "drop_consonant": int((~flap & ~n_dropped).sum())})
+    codes = codes.copy()
+    codes[pos[flap]] = ord("ɾ")
+    keep = np.ones(n, dtype=bool)
+    keep[pos[~flap]] = False
+    return codes[keep].tobytes().decode("utf-16-le").split(_TD_SEP)
+
+def handle_t_d_batch(lines: List[str]) -> List[str]:
+    """[handle_t_d(line) for line in lines], vectorized when NumPy is installed and the batch is large enough"""
+    if len(lines) < TD_BATCH_MIN_LINES or _numpy() is None or any(_TD_SEP in line for line in lines):
+        return [handle_t_d(line) for line in lines]
+    return _handle_t_d_numpy(lines)
+
 def normalize(text: str):
     text = text.replace("’", "'").replace("‘", "'").replace('”', '"').replace('“', '"').replace("—", " - ")
     text = unicodedata.normalize('NFD', text)
@@ -274,6 +921,11 @@ def fix_numbers(text_arr: List[str]):
 
 _flite_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flite', 'bin', 'flite')
 
+_flite_init_lock = threading.Lock()
+
+# Every flite call starts its own process ("flite -t <text> -i"). flite only reads text from -t or a whole file, so a
+# pool of long lived flite processes has to wait for a framed stdin mode in our flite fork. Until then FliteDriver
+# runs the processes in parallel. An in process flite through ctypes waits for the same fork, it needs a C export
 def _call_flite(text: str) -> str:
     try:
         return subprocess.check_output([_flite_path, "-t", text, "-i"]).decode('utf-8')
@@ -287,59 +939,73 @@ def _call_flite(text: str) -> str:
 def run_flite(text: str):
     fixed_text = text
     # fixed_text = " ".join(fix_numbers(fix_nn(text.lower())))
-    ipa_text = _call_flite(fixed_text)
-
-    ipa_text = add_reductions_with_stress(ipa_text, fixed_text)
-    ipa_text = add_double_word_reductions(ipa_text, fixed_text)
-    #from here on out, fixed_text can no longer be trusted (length doesn't match the ipa_text length)
-    ipa_text = handle_t_d(ipa_text)
-    #remove stress marks
-    ipa_text = ipa_text.replace("ˈ", "")
-    return fixed_text, ipa_text
+    transcription = transcribe(fixed_text)
+    return transcription.text, transcription.ipa
 
 sentence_enders = '''.!?'")]}:;>0123456789'''
-
-cached_text = ""
-line_end_count = 0
-is_chapter = False
-def fix_line_ending(line: str) -> Optional[str]:
-    """returns None if we should skip flite and go to the next word. Otherwise returns the text to parse"""
-    global is_chapter
-    global cached_text
-    global line_end_count
-    stripped = line.strip()
-    if len(stripped) > 0 and stripped[-1] not in sentence_enders:
-        if stripped in ("PROLOGUE", "CHAPTER", "EPILOGUE"):
-            is_chapter = True
-            temp = cached_text
-            cached_text = "\n" + line[:-1] + " "
-            return None if temp == "" else temp
-
-        cached_text += line.replace("\n", "")
-        if is_chapter:
-            is_chapter = False
-            temp = cached_text + "\n\n"
-            cached_text = ""
-            return temp
-
-        cached_text += " "
-        return None
-    # If we reached here, either line is "\n" or it ends with an endmark. is_missing_endmark refers to the prev line now
-    if cached_text != "":
-        if line == "\n":
-            return None
-        line = cached_text + line
-        cached_text = ""
-        line_end_count = 0
-        return line
-    if line == "\n":
-        line_end_count += 1
-        if line_end_count > 1:
+CHAPTER_HEADINGS = ("PROLOGUE", "CHAPTER", "EPILOGUE")
+
+class LineJoiner:
+    """Joins the lines of one document into the texts to transcribe: sentences broken over several lines, chapter
+    headers with their titles. Each document (or parallel pipeline) needs its own"""
+    __slots__ = ("cached_text", "line_end_count", "is_chapter")
+
+    def __init__(self):
+        self.cached_text = ""
+        self.line_end_count = 0
+        self.is_chapter = False
+
+    def snapshot(self) -> Dict[str, object]:
+        return {"cached_text": self.cached_text, "line_end_count": self.line_end_count, "is_chapter": self.is_chapter}
+
+    @classmethod
+    def restore(cls, state: Mapping[str, object]) -> "LineJoiner":
+        joiner = cls()
+        joiner.cached_text = state.get("cached_text", "")
+        joiner.line_end_count = state.get("line_end_count", 0)
+        joiner.is_chapter = state.get("is_chapter", False)
+        return joiner
+
+    def fix_line_ending(self, line: str) -> Optional[str]:
+        """returns None if we should skip flite and go to the next word. Otherwise returns the text to parse"""
+        stripped = line.strip()
+        if len(stripped) > 0 and stripped[-1] not in sentence_enders:
+            if stripped in CHAPTER_HEADINGS:
+                self.is_chapter = True
+                temp = self.cached_text
+                self.cached_text = "\n" + line[:-1] + " "
+                return None if temp == "" else temp
+
+            self.cached_text += line.replace("\n", "")
+            if self.is_chapter:
+                self.is_chapter = False
+                temp = self.cached_text + "\n\n"
+                self.cached_text = ""
+                return temp
+
+            self.cached_text += " "
             return None
+        # If we reached here, either line is "\n" or it ends with an endmark. is_missing_endmark refers to the prev line now
+        if self.cached_text != "":
+            if line == "\n":
+                return None
+            line = self.cached_text + line
+            self.cached_text = ""
+            self.line_end_count = 0
+            return line
+        if line == "\n":
+            self.line_end_count += 1
+            if self.line_end_count > 1:
+                return None
+            return line
+        self.line_end_count = 0
+        self.is_chapter = False
         return line
-    line_end_count = 0
-    is_chapter = False
-    return line
+
+    def flush(self) -> Optional[str]:
+        """The text still waiting for the end of its sentence at the end of the document, if any"""
+        text, self.cached_text = self.cached_text, ""
+        return text or None
 
 CHECKPOINT_INTERVAL = 10
 
@@ -362,97 +1028,1046 @@ def remove_checkpoint(checkpoint_path):
     if os.path.exists(checkpoint_path):
         os.remove(checkpoint_path)
 
+_flite_fingerprint_cache: Dict[str, str] = {}
+
+def _flite_fingerprint() -> str:
+    """Hash of the flite binary, so cached flite output is dropped when flite is rebuilt"""
+    if _flite_path not in _flite_fingerprint_cache:
+        digest = hashlib.sha1()
+        if os.path.isfile(_flite_path):
+            with open(_flite_path, "rb") as f:
+                digest.update(f.read())
+        _flite_fingerprint_cache[_flite_path] = digest.hexdigest()
+    return _flite_fingerprint_cache[_flite_path]
+
+def _split_word_token(token: str) -> Tuple[str, str, str]:
+    core = token.strip(string.punctuation)
+    if core == "":
+        return token, "", ""
+    start = token.index(core)
+    return token[:start], core, token[start + len(core):]
+
+# Words flite reads differently depending on the sentence around them. Lines holding them always go to flite as a whole
+context_words = {"read", "lead", "live", "lives", "wind", "winds", "tear", "tears", "close", "closer", "use", "used", "uses",
+                 "record", "present", "object", "wound", "bow", "bows", "row", "rows", "minute", "content", "desert", "does",
+                 "refuse", "permit", "produce", "project", "separate", "estimate", "moderate", "perfect", "polish", "house",
+                 "excuse", "sow", "bass", "dove", "number", "invalid", "console", "conduct", "contract", "subject", "conflict",
+                 "increase", "decrease", "progress", "rebel", "suspect", "alternate", "appropriate", "associate", "deliberate",
+                 "graduate", "intimate", "approximate", "advocate", "elaborate", "duplicate", "learned", "blessed", "aged",
+                 "wicked", "lean", "putting", "sewer", "entrance", "incense", "invite", "attribute", "combine", "compact"}
+
+abbreviations = {"mr", "mrs", "ms", "dr", "st", "jr", "sr", "mt", "ft", "vs", "etc", "prof", "gen", "col", "lt", "capt", "sgt",
+                 "no", "vol", "ch", "co", "inc", "ltd", "ave", "rd", "dept", "est"}
+
+# Words flite reads by the sound after them: "ðə kæt" but "ði aɪ". Cached once per following sound, see _next_sound
+next_sound_words = {"the", "a", "an", "to"}
+NEXT_SOUNDS = ("V", "C", "")
+
+def _next_sound(next_ipa: str) -> str:
+    """V if the next word starts with a vowel sound, C for a consonant, "" at the end of the text"""
+    if next_ipa == "":
+        return ""
+    return "V" if next_ipa.lstrip("ˈˌ")[:1] in ipa_vowels + "ɝ" else "C"
+
+def _word_cache_key(core: str, suffix: str = "", next_ipa: Optional[str] = None) -> Optional[str]:
+    """None for words flite may read differently in context (numbers, abbreviations and homographs). next_sound_words
+    are keyed with the sound of next_ipa, the next word's pronunciation ("" at the end, None if it isn't a word)"""
+    if not all(c.isalpha() or c in "'-" for c in core):
+        return None
+    if suffix.startswith(".") and (len(core) == 1 or core.lower() in abbreviations):
+        return None
+    if core.lower() in context_words:
+        return None
+    # all caps words may be read as acronyms ("A" as the letter), so don't merge them with the lower case word
+    word = core if core.isupper() else core.lower()
+    if core.lower() in next_sound_words:
+        return None if next_ipa is None else f"{word} {_next_sound(next_ipa)}"
+    return word
+
+def _word_ipa(token: str, ipa_token: str) -> Optional[str]:
+    """The pronunciation of token's word in ipa_token, None if token isn't a word or ipa_token doesn't wrap it the same way"""
+    prefix, core, suffix = _split_word_token(token)
+    if core == "" or not ipa_token.startswith(prefix) or not ipa_token.endswith(suffix):
+        return None
+    return ipa_token[len(prefix):len(ipa_token) - len(suffix)] or None
+
+def _assemble_from_words(text: str, lexicon: Mapping[str, str], keys: Optional[Dict[int, str]] = None) -> Optional[str]:
+    """Rebuilds flite's output for text from per word pronunciations, with the book_words put in. None if a word is
+    missing. keys gets the lexicon key used for each word, by its index in text.split()"""
+    tokens = text.split()
+    out = [""] * len(tokens)
+    # right to left, next_sound_words need the pronunciation of the word after them
+    next_ipa: Optional[str] = ""
+    for i in range(len(tokens) - 1, -1, -1):
+        prefix, core, suffix = _split_word_token(tokens[i])
+        if core == "":
+            out[i] = tokens[i]
+            next_ipa = None
+            continue
+        # book_words are keyed by the lower case word, whatever case the word cache keeps
+        ipa = book_words.get(core.lower())
+        if ipa is None:
+            key = _word_cache_key(core, suffix, next_ipa)
+            ipa = lexicon.get(key) if key is not None else None
+            if ipa is None:
+                return None
+            if keys is not None:
+                keys[i] = key
+        out[i] = prefix + ipa + suffix
+        next_ipa = ipa
+    return " ".join(out) + text[len(text.rstrip()):] + "\n"
+
+def _harvest_words(text: str, raw_ipa: str) -> Dict[str, str]:
+    """Per word pronunciations from one flite call. Only kept if words map one to one, the way _assemble_from_words rebuilds them"""
+    tokens = text.split()
+    ipa_tokens = raw_ipa.split()
+    if len(tokens) != len(ipa_tokens) or " ".join(ipa_tokens) + text[len(text.rstrip()):] + "\n" != raw_ipa:
+        return {}
+    words = {}
+    for i, (token, ipa_token) in enumerate(zip(tokens, ipa_tokens)):
+        prefix, core, suffix = _split_word_token(token)
+        if core == "":
+            if ipa_token != token:
+                return {}
+            continue
+        ipa = _word_ipa(token, ipa_token)
+        if ipa is None:
+            return {}
+        next_ipa = _word_ipa(tokens[i + 1], ipa_tokens[i + 1]) if i + 1 < len(tokens) else ""
+        key = _word_cache_key(core, suffix, next_ipa)
+        if key is None:
+            continue
+        if words.setdefault(key, ipa) != ipa:
+            return {}
+    return words
+
+def _text_words(texts: Iterable[str]) -> Set[str]:
+    """Every cache key the texts' words may need. next_sound_words get a key per following sound"""
+    words = set()
+    for text in texts:
+        for token in text.split():
+            _, core, suffix = _split_word_token(token)
+            key = _word_cache_key(core, suffix, "") if core else None
+            if key and core.lower() in next_sound_words:
+                words.update(key + sound for sound in NEXT_SOUNDS)
+            elif key:
+                words.add(key)
+    return words
+
+WORD_CACHE_MAX_ENTRIES = 200000
+# Bumped when _word_cache_key changes, so words stored under the old keys aren't read back
+WORD_CACHE_KEY_VERSION = 2
+
+class WordCache:
+    """sqlite backed word -> raw flite IPA cache, shared between books and runs. Least recently used words are evicted"""
+    def __init__(self, path: str, max_entries: int = WORD_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.flite = f"{_flite_fingerprint()}/{WORD_CACHE_KEY_VERSION}"
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._touched: Dict[str, int] = {}
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS words (word TEXT NOT NULL, flite TEXT NOT NULL, ipa TEXT NOT NULL,"
+                         " used INTEGER NOT NULL, PRIMARY KEY (word, flite))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS words_used ON words (used)")
+        self._clock = self._db.execute("SELECT COALESCE(MAX(used), 0) FROM words").fetchone()[0]
+
+    def get_many(self, words) -> Dict[str, str]:
+        words = list(set(words))
+        found = {}
+        with self._lock:
+            for start in range(0, len(words), 500):
+                chunk = words[start:start + 500]
+                rows = self._db.execute(f"SELECT word, ipa FROM words WHERE flite = ? AND word IN ({','.join('?' * len(chunk))})",
+                                        [self.flite] + chunk)
+                found.update(rows)
+            self._clock += 1
+            for word in found:
+                self._touched[word] = self._clock
+        return found
+
+    def count(self, hits: int, misses: int):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def put_many(self, words: Dict[str, str]):
+        if not words:
+            return
+        with self._lock:
+            self._clock += 1
+            self._db.executemany("INSERT OR REPLACE INTO words (word, flite, ipa, used) VALUES (?, ?, ?, ?)",
+                                 [(word, self.flite, ipa, self._clock) for word, ipa in words.items()])
+
+    def flush(self):
+        with self._lock:
+            self._db.executemany("UPDATE words SET used = ? WHERE word = ? AND flite = ?",
+                                 [(used, word, self.flite) for word, used in self._touched.items()])
+            self._touched.clear()
+            excess = self._db.execute("SELECT COUNT(*) FROM words").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._db.execute("DELETE FROM words WHERE rowid IN (SELECT rowid FROM words ORDER BY used LIMIT ?)", (excess,))
+            self._db.commit()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        with self._lock:
+            size = self._db.execute("SELECT COUNT(*) FROM words").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0, "entries": size}
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+word_cache: Optional[WordCache] = None
+
+def _rules_fingerprint() -> str:
+    """Changes whenever a rule table, a rule function, the flite chunking or flite changes"""
+    digest = hashlib.sha1()
+    tables = [normal_reductions, h_reduction, double_word_reductions, double_word_with_verb, improved_pronounciations,
+              book_words, sorted(t_d_skip_words), verb_backend, sorted(VERB_WORDS), sorted(NON_VERB_WORDS), VERB_SUFFIXES]
+    digest.update(json.dumps(tables, ensure_ascii=False).encode('utf-8'))
+    for func in (add_reductions_with_stress, add_double_word_reductions, handle_t_d, is_verb_in_sentence, is_verb_word, _reduce_word, AhoCorasick,
+                 _double_word_plan, _split_t_d_clusters, _handle_word_t_d, apply_rules_fused, _handle_t_d_numpy,
+                 _split_long_text, _sentence_pieces, _stitch_flite_chunks):
+        digest.update(inspect.getsource(func).encode('utf-8'))
+    # where long texts are cut changes what flite reads
+    digest.update(f"{FLITE_CHUNK_CHARS} {SENTENCE_END_PATTERN.pattern} {CLAUSE_END_PATTERN.pattern}".encode('utf-8'))
+    digest.update(_flite_fingerprint().encode('utf-8'))
+    return digest.hexdigest()
+
+class ResultCache:
+    """sqlite cache of finished transcriptions, keyed by the normalized text and the rules fingerprint. Setups with
+    different rules can share the file, entries of other rules are only dropped by prune()"""
+    def __init__(self, path: str):
+        self.rules = _rules_fingerprint()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS results (text_hash TEXT NOT NULL, rules TEXT NOT NULL, ipa TEXT NOT NULL,"
+                         " PRIMARY KEY (text_hash, rules))")
+
+    def prune(self) -> int:
+        """Drops the entries made with other rules, returns how many"""
+        with self._lock:
+            dropped = self._db.execute("DELETE FROM results WHERE rules != ?", (self.rules,)).rowcount
+            self._db.commit()
+        return dropped
+
+    @staticmethod
+    def _hash(text: str) -> str:
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get_many(self, texts: List[str]) -> Dict[str, str]:
+        hashes = {self._hash(text): text for text in texts}
+        found = {}
+        with self._lock:
+            keys = list(hashes)
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._db.execute(f"SELECT text_hash, ipa FROM results WHERE rules = ? AND text_hash IN ({','.join('?' * len(chunk))})",
+                                        [self.rules] + chunk)
+                for text_hash, ipa in rows:
+                    found[hashes[text_hash]] = ipa
+            self.hits += sum(1 for text in texts if text in found)
+            self.misses += sum(1 for text in texts if text not in found)
+        return found
+
+    def put_many(self, results: List[Tuple[str, str]]):
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO results (text_hash, rules, ipa) VALUES (?, ?, ?)",
+                                 [(self._hash(text), self.rules, ipa) for text, ipa in results])
+
+    def flush(self):
+        with self._lock:
+            self._db.commit()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+result_cache: Optional[ResultCache] = None
+
+def _available_cpus() -> int:
+    """CPUs this process may really use: the affinity mask, capped by a cgroup CPU quota (containers, CI runners)"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            max_us, period_us = f.read().split()
+            if max_us != "max":
+                quota = int(max_us) / int(period_us)
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f_quota, open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f_period:
+                max_us = int(f_quota.read())
+                if max_us > 0:
+                    quota = max_us / int(f_period.read())
+        except (OSError, ValueError):
+            pass
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return max(1, cpus)
+
+# Both can be set with --batch-size / --jobs. FLITE_BATCH_SIZE is also the starting point of the auto window
 FLITE_BATCH_SIZE = 32
-FLITE_MAX_WORKERS = 8
-
-def _run_flite_batch(texts: List[str]) -> List[Tuple[str, str]]:
-    with ThreadPoolExecutor(max_workers=FLITE_MAX_WORKERS) as executor:
-        ipa_results = list(executor.map(_call_flite, texts))
-    results = []
-    for fixed_text, ipa_text in zip(texts, ipa_results):
-        ipa_text = add_reductions_with_stress(ipa_text, fixed_text)
-        ipa_text = add_double_word_reductions(ipa_text, fixed_text)
-        ipa_text = handle_t_d(ipa_text)
-        ipa_text = ipa_text.replace("ˈ", "")
-        results.append((fixed_text, ipa_text))
+FLITE_MAX_WORKERS = _available_cpus()
+
+class AdaptiveWindow:
+    """Number of texts to keep in flight for --batch-size auto. While the oldest text runs, the other workers keep
+    finishing texts, and the window has to hold all of those or workers go idle. So it aims at
+    jobs * (1 + slow latency / average latency), tracked as flite runs, and doesn't grow while texts are already queued"""
+    MAX_PER_JOB = 64
+
+    def __init__(self, jobs: int, start: int = FLITE_BATCH_SIZE):
+        self.jobs = jobs
+        self.size = max(jobs, start)
+        self._mean: Optional[float] = None
+        self._slow = 0.0
+
+    def observe(self, latency: float, queue_depth: int):
+        self._mean = latency if self._mean is None else self._mean * 0.95 + latency * 0.05
+        self._slow = max(latency, self._slow * 0.99)
+        target = self.jobs * (1 + math.ceil(self._slow / max(self._mean, 1e-6)))
+        target = min(max(target, self.jobs), self.jobs * self.MAX_PER_JOB)
+        if target > self.size and queue_depth < self.jobs:
+            self.size = min(target, self.size + max(1, self.size // 4))
+        elif target < self.size:
+            self.size = max(target, self.size - max(1, self.size // 8))
+
+adaptive_window: Optional[AdaptiveWindow] = None
+
+# Documents directory mode is transcribing at once. They split the window between them, so the whole process keeps one budget
+open_documents = 0
+_open_documents_lock = threading.Lock()
+
+def _total_window() -> int:
+    """Texts in flight over all the open documents"""
+    return adaptive_window.size if adaptive_window is not None else FLITE_BATCH_SIZE
+
+def _window_size() -> int:
+    return max(1, -(-_total_window() // max(1, open_documents)))
+
+async def _call_flite_async(text: str) -> str:
+    try:
+        process = await asyncio.create_subprocess_exec(_flite_path, "-t", text, "-i", stdout=asyncio.subprocess.PIPE)
+    except OSError:
+        logging.warning('lex_lookup (from flite) is not installed.')
+        return ''
+    out, _ = await process.communicate()
+    if process.returncode != 0:
+        logging.warning('Non-zero exit status from lex_lookup.')
+        return ''
+    return out.decode('utf-8')
+
+FLITE_COST_PER_WORD = 5
+
+def _flite_cost(text: str) -> int:
+    """Rough guess of flite's run time on text, in characters"""
+    return len(text) + FLITE_COST_PER_WORD * text.count(" ")
+
+# Texts longer than this go to flite in sentence sized chunks, run in parallel. flite's time per utterance grows
+# faster than its length, and a long paragraph stays one huge argv entry for the one shot backends
+FLITE_CHUNK_CHARS = 1000
+SENTENCE_END_PATTERN = re.compile(r'[.!?]["\'”’)\]]* ')
+
+CLAUSE_END_PATTERN = re.compile(r'[,;:—]["\'”’)\]]*$')
+
+def _sentence_pieces(sentence: str, max_chars: int) -> List[str]:
+    """A sentence longer than max_chars in pieces: its clauses, and clauses still too long at spaces. Never right after
+    one of the next_sound_words, flite reads those by the word after them"""
+    pieces: List[str] = []
+    clause: List[str] = []
+    for word in sentence.split(" "):
+        clause.append(word)
+        if CLAUSE_END_PATTERN.search(word) and _split_word_token(word)[1].lower() not in next_sound_words:
+            pieces.append(" ".join(clause))
+            clause = []
+    if clause:
+        pieces.append(" ".join(clause))
+    if all(len(piece) <= max_chars for piece in pieces):
+        return pieces
+    split: List[str] = []
+    for piece in pieces:
+        if len(piece) <= max_chars:
+            split.append(piece)
+            continue
+        glued = ""
+        for word in piece.split(" "):
+            glued = f"{glued} {word}" if glued else word
+            if _split_word_token(word)[1].lower() not in next_sound_words:
+                split.append(glued)
+                glued = ""
+        if glued:
+            split.append(glued)
+    return split
+
+def _split_long_text(text: str, max_chars: Optional[int] = None) -> List[str]:
+    """Splits text at sentence ends into chunks of up to max_chars (default FLITE_CHUNK_CHARS). A longer sentence is
+    split at its clauses, and at spaces if a clause is longer still. The chunks hold exactly the words of text, in order"""
+    max_chars = max_chars or FLITE_CHUNK_CHARS
+    if len(text) <= max_chars:
+        return [text]
+    body = text.rstrip()
+    cuts = [m.end() - 1 for m in SENTENCE_END_PATTERN.finditer(body)]
+    pieces = []
+    for start, end in zip([-1] + cuts, cuts + [len(body)]):
+        sentence = body[start + 1:end]
+        pieces += [sentence] if len(sentence) <= max_chars else _sentence_pieces(sentence, max_chars)
+    chunks = []
+    for piece in pieces:
+        if piece == "":
+            continue
+        if chunks and len(chunks[-1]) + 1 + len(piece) <= max_chars:
+            chunks[-1] += " " + piece
+        else:
+            chunks.append(piece)
+    return chunks
+
+def _stitch_flite_chunks(text: str, outputs: List[str]) -> str:
+    """flite's output for text from its output for the chunks of _split_long_text, so the words still line up with text"""
+    if any(out.strip() == "" for out in outputs):
+        return ""
+    return " ".join(out.strip() for out in outputs) + text[len(text.rstrip()):] + "\n"
+
+class FliteDriver:
+    """One asyncio loop, on its own thread, running every flite call of the process. max_in_flight worker tasks run the
+    calls, picking the most expensive text that is waiting, so a long paragraph doesn't start last and hold up the
+    whole window. A text that waited while a whole window of newer texts was submitted goes first, oldest first, so
+    short lines (or another document's) aren't starved and the in order writers keep moving. Callers still get their
+    results in their own order"""
+    def __init__(self, max_in_flight: Optional[int] = None):
+        max_in_flight = max_in_flight or FLITE_MAX_WORKERS
+        self.max_in_flight = max_in_flight
+        self.loop = asyncio.new_event_loop()
+        # every waiting job is [-cost, order, text, future, taken], in both the cost heap and the submission order fifo
+        self._heap: List[list] = []
+        self._fifo: Deque[list] = deque()
+        self._waiting = 0
+        self._submitted = 0
+        self._ready: Optional[asyncio.Semaphore] = None
+        self._order = itertools.count()
+        self._busy_time = 0.0
+        self._calls = 0
+        self._first_start: Optional[float] = None
+        self._last_end = 0.0
+        self._thread = threading.Thread(target=self.loop.run_forever, name="flite-driver", daemon=True)
+        self._thread.start()
+        self._workers: List["asyncio.Task[None]"] = []
+        self.loop.call_soon_threadsafe(self._start_workers)
+
+    def _start_workers(self):
+        self._ready = asyncio.Semaphore(0)
+        self._workers = [self.loop.create_task(self._worker()) for _ in range(self.max_in_flight)]
+
+    def _put(self, job: list):
+        heapq.heappush(self._heap, job)
+        self._fifo.append(job)
+        self._waiting += 1
+        self._submitted = job[1] + 1
+        self._ready.release()
+
+    def _take(self) -> list:
+        while self._fifo[0][4]:
+            self._fifo.popleft()
+        if self._submitted - self._fifo[0][1] > _total_window():
+            job = self._fifo.popleft()
+        else:
+            while self._heap[0][4]:
+                heapq.heappop(self._heap)
+            job = heapq.heappop(self._heap)
+        job[4] = True
+        self._waiting -= 1
+        return job
+
+    def _stop_workers(self):
+        for worker in self._workers:
+            worker.cancel()
+        # the cancelled workers finish on the next loop iteration, stop after it
+        self.loop.call_soon(self.loop.stop)
+
+    async def _worker(self):
+        while True:
+            await self._ready.acquire()
+            _, _, text, future, _ = self._take()
+            if not future.set_running_or_notify_cancel():
+                continue
+            start = time.perf_counter()
+            if self._first_start is None:
+                self._first_start = start
+            try:
+                future.set_result(await _call_flite_async(text))
+            except Exception as e:
+                future.set_exception(e)
+            end = time.perf_counter()
+            self._busy_time += end - start
+            self._calls += 1
+            self._last_end = max(self._last_end, end)
+            if adaptive_window is not None:
+                adaptive_window.observe(end - start, self._waiting)
+
+    def _submit_one(self, text: str) -> "concurrent.futures.Future[str]":
+        future: "concurrent.futures.Future[str]" = concurrent.futures.Future()
+        self.loop.call_soon_threadsafe(self._put, [-_flite_cost(text), next(self._order), text, future, False])
+        return future
+
+    def submit(self, text: str) -> "concurrent.futures.Future[str]":
+        chunks = _split_long_text(text)
+        if len(chunks) == 1:
+            return self._submit_one(text)
+        parts = [self._submit_one(chunk) for chunk in chunks]
+        future: "concurrent.futures.Future[str]" = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
+        remaining = [len(parts)]
+        lock = threading.Lock()
+
+        def part_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            try:
+                future.set_result(_stitch_flite_chunks(text, [part.result() for part in parts]))
+            except Exception as e:
+                future.set_exception(e)
+        for part in parts:
+            part.add_done_callback(part_done)
+        return future
+
+    def map_ordered(self, texts: Iterable[str], window: Optional[int] = None) -> Iterator[str]:
+        """Yields flite's output for texts in order, as soon as the oldest one is done.
+        texts is only read while less than window (default _window_size()) texts are waiting, so a slow flite holds the reader back"""
+        pending: Deque["concurrent.futures.Future[str]"] = deque()
+        for text in texts:
+            pending.append(self.submit(text))
+            while len(pending) >= (window or _window_size()):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def stats(self) -> Dict[str, float]:
+        """makespan: seconds from the first flite call starting to the last one ending. utilisation: busy share of the workers in that time"""
+        makespan = self._last_end - self._first_start if self._first_start is not None else 0.0
+        return {"calls": self._calls, "makespan": makespan, "busy": self._busy_time,
+                "utilisation": self._busy_time / (makespan * self.max_in_flight) if makespan > 0 else 0.0}
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self._stop_workers)
+        self._thread.join()
+        self.loop.close()
+
+_flite_driver: Optional[FliteDriver] = None
+
+def _get_flite_driver() -> FliteDriver:
+    global _flite_driver
+    with _flite_init_lock:
+        if _flite_driver is None:
+            _flite_driver = FliteDriver()
+            atexit.register(_flite_driver.close)
+        return _flite_driver
+
+def _forget_flite_workers():
+    """A forked child has none of the parent's driver thread, it starts its own when it needs one"""
+    global _flite_driver, _flite_init_lock
+    _flite_driver = None
+    _flite_init_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_forget_flite_workers)
+
+VOCAB_CHUNK_WORDS = 1000
+# words on each side of a word when its list pronunciation is checked against flite
+VOCAB_CHECK_CONTEXT = 2
+# next_sound_words are pronounced in "<word> eye <word> cat <word>", once before a vowel, a consonant and the end
+VOCAB_PROBE = "{0} eye {0} cat {0}\n"
+class _DocumentState(threading.local):
+    """State of the document the current thread is transcribing, so directory mode can run documents side by side"""
+    # Set by the vocabulary prepass: pronunciation of every word of the current input
+    vocab_lexicon: Optional[Dict[str, str]] = None
+
+document_state = _DocumentState()
+
+def _phonemize_words(words: List[str]) -> Dict[str, str]:
+    """Pronounces a word list with one flite call per VOCAB_CHUNK_WORDS words. A chunk flite doesn't answer word for word is halved until it does"""
+    lexicon: Dict[str, str] = {}
+    chunks = [words[i:i + VOCAB_CHUNK_WORDS] for i in range(0, len(words), VOCAB_CHUNK_WORDS)]
+    while chunks:
+        halved = []
+        for chunk, raw_ipa in zip(chunks, _get_flite_driver().map_ordered(" ".join(chunk) + "\n" for chunk in chunks)):
+            ipa_tokens = raw_ipa.split()
+            if len(ipa_tokens) == len(chunk):
+                lexicon.update(zip(chunk, ipa_tokens))
+            elif len(chunk) > 1:
+                halved += [chunk[:len(chunk) // 2], chunk[len(chunk) // 2:]]
+        chunks = halved
+    return lexicon
+
+def _flite_in_bulk(texts: List[str]) -> List[Optional[str]]:
+    """flite's output for every text, from a few large calls of VOCAB_CHUNK_WORDS words. flite starts a new utterance
+    at a blank line, so texts joined by one are read like on their own. None for the texts of a call flite doesn't
+    answer word for word, even after halving it"""
+    outputs: List[Optional[str]] = [None] * len(texts)
+    chunks: List[List[int]] = []
+    words = VOCAB_CHUNK_WORDS
+    for i, text in enumerate(texts):
+        if words >= VOCAB_CHUNK_WORDS:
+            chunks.append([])
+            words = 0
+        chunks[-1].append(i)
+        words += len(text.split())
+    while chunks:
+        halved = []
+        calls = ["\n\n".join(texts[i].rstrip() for i in chunk) + "\n" for chunk in chunks]
+        for chunk, raw_ipa in zip(chunks, _get_flite_driver().map_ordered(calls)):
+            ipa_tokens = raw_ipa.split()
+            # framed like a single text: the words joined by single spaces, "\n" and the new line flite adds
+            if len(ipa_tokens) == sum(len(texts[i].split()) for i in chunk) and " ".join(ipa_tokens) + "\n\n" == raw_ipa:
+                for i in chunk:
+                    count = len(texts[i].split())
+                    outputs[i] = " ".join(ipa_tokens[:count]) + texts[i][len(texts[i].rstrip()):] + "\n"
+                    ipa_tokens = ipa_tokens[count:]
+            elif len(chunk) > 1:
+                halved += [chunk[:len(chunk) // 2], chunk[len(chunk) // 2:]]
+        chunks = halved
+    return outputs
+
+def _check_windows(text: str, used: Dict[int, str], checked: Set[str]) -> List[str]:
+    """The words of text around each of its keys not in checked: VOCAB_CHECK_CONTEXT words on both sides, or up to
+    the end of text, overlapping ones merged. Adds the keys to checked"""
+    tokens = text.split()
+    windows: List[List[int]] = []
+    for i in sorted(used):
+        if used[i] in checked:
+            continue
+        checked.add(used[i])
+        start = max(0, i - VOCAB_CHECK_CONTEXT)
+        end = min(len(tokens), i + VOCAB_CHECK_CONTEXT + 1)
+        if windows and start <= windows[-1][1]:
+            windows[-1][1] = end
+        else:
+            windows.append([start, end])
+    return [" ".join(tokens[start:end]) + (text[len(text.rstrip()):] if end == len(tokens) else "\n") for start, end in windows]
+
+def build_vocabulary_lexicon(texts: List[str]) -> Dict[str, str]:
+    """Pronounces all the words of texts in a few large flite calls. Every pronunciation is then checked where the text
+    first uses it, with the words around it, against flite's output for those words. Words that don't match are
+    dropped, the lines using them run flite on their own"""
+    keys = _text_words(texts)
+    lexicon = _phonemize_words(sorted(key for key in keys if " " not in key))
+    probes = sorted({key.rsplit(" ", 1)[0] for key in keys if " " in key})
+    for word, raw_ipa in zip(probes, _get_flite_driver().map_ordered(VOCAB_PROBE.format(word) for word in probes)):
+        lexicon.update((key, ipa) for key, ipa in _harvest_words(VOCAB_PROBE.format(word), raw_ipa).items() if " " in key)
+
+    # a word said in a list may not sound like the same word in a sentence. The word after it changes some words (the
+    # next_sound_words) and the words around it how flite splits and reads tokens, so the check keeps those
+    checked: Set[str] = set()
+    windows: List[str] = []
+    for text in texts:
+        used: Dict[int, str] = {}
+        if _assemble_from_words(text, lexicon, used) is not None:
+            windows += _check_windows(text, used, checked)
+    right: Set[str] = set()
+    wrong: Set[str] = set()
+    for window, flite_ipa in zip(windows, _flite_in_bulk(windows)):
+        used = {}
+        raw_ipa = _assemble_from_words(window, lexicon, used)
+        (right if raw_ipa is not None and raw_ipa == _apply_book_words(window, flite_ipa or "") else wrong).update(used.values())
+    wrong -= right
+    if wrong:
+        logging.warning(f'vocabulary prepass: {len(wrong)} words don\'t match flite in a sentence, their lines run flite per line.')
+    return {key: ipa for key, ipa in lexicon.items() if key not in wrong}
+
+def _apply_rules(ipa_text: str, fixed_text: str) -> str:
+    fused = apply_rules_fused(ipa_text, fixed_text)
+    if fused is not None:
+        return fused
+    ipa_text = add_reductions_with_stress(ipa_text, fixed_text)
+    ipa_text = add_double_word_reductions(ipa_text, fixed_text)
+    #from here on out, fixed_text can no longer be trusted (length doesn't match the ipa_text length)
+    ipa_text = handle_t_d(ipa_text)
+    #remove stress marks
+    return ipa_text.replace("ˈ", "")
+
+def _start_transcription(text: str) -> Tuple[Optional[str], Union[None, str, "concurrent.futures.Future[str]"]]:
+    """Returns (final ipa, None) on a result cache hit, otherwise (None, raw flite output or a future of it).
+    With a word cache or a prepass lexicon, flite only runs for texts holding unknown words"""
+    if result_cache is not None:
+        found = result_cache.get_many([text])
+        if text in found:
+            return found[text], None
+    vocab_lexicon = document_state.vocab_lexicon
+    if word_cache is not None or vocab_lexicon is not None or book_words:
+        lexicon: Mapping[str, str] = vocab_lexicon or {}
+        if word_cache is not None:
+            keys = {key for key in _text_words([text]) if key not in lexicon}
+            found = word_cache.get_many(keys)
+            word_cache.count(len(found), len(keys) - len(found))
+            lexicon = ChainMap(found, lexicon)
+        raw_ipa = _assemble_from_words(text, lexicon)
+        if raw_ipa is not None:
+            return None, raw_ipa
+    return None, _get_flite_driver().submit(text)
+
+def _apply_rules_batch(pairs: List[Tuple[str, str]]) -> List[str]:
+    """_apply_rules for many (ipa_text, fixed_text) pairs. Large batches get their t/d handling from handle_t_d_batch"""
+    tag_sentences(fixed_text for _, fixed_text in pairs if needs_pos_tags(fixed_text))
+    if len(pairs) < TD_BATCH_MIN_LINES or _numpy() is None:
+        return [_apply_rules(ipa_text, fixed_text) for ipa_text, fixed_text in pairs]
+    reduced = [add_double_word_reductions(add_reductions_with_stress(ipa_text, fixed_text), fixed_text) for ipa_text, fixed_text in pairs]
+    return [ipa_text.replace("ˈ", "") for ipa_text in handle_t_d_batch(reduced)]
+
+def _finish_transcriptions(started: List[Tuple[str, Optional[str], object]]) -> List[str]:
+    """Final ipa for (text, ipa, raw_ipa) triples from _start_transcription, waiting for flite where needed"""
+    results: List[Optional[str]] = []
+    to_rule = []
+    for text, ipa, raw_ipa in started:
+        results.append(ipa)
+        if ipa is not None:
+            continue
+        if isinstance(raw_ipa, concurrent.futures.Future):
+            raw_ipa = raw_ipa.result()
+            if word_cache is not None:
+                word_cache.put_many(_harvest_words(text, raw_ipa))
+            raw_ipa = _apply_book_words(text, raw_ipa)
+        to_rule.append((len(results) - 1, raw_ipa, text))
+    for (i, _, text), ipa in zip(to_rule, _apply_rules_batch([(raw_ipa, text) for _, raw_ipa, text in to_rule])):
+        results[i] = ipa
+    if result_cache is not None and to_rule:
+        result_cache.put_many([(text, results[i]) for i, _, text in to_rule])
     return results
 
-def print_ipa(out_file: Optional[TextIOWrapper], lines: List[str], fix_line_ends: bool = True, checkpoint_path: Optional[str] = None, start_line: int = 0):
-    global cached_text
-    total = len(lines)
+def _finish_transcription(text: str, ipa: Optional[str], raw_ipa) -> str:
+    return _finish_transcriptions([(text, ipa, raw_ipa)])[0]
+
+def _flush_caches():
+    if word_cache is not None:
+        word_cache.flush()
+    if result_cache is not None:
+        result_cache.flush()
 
-    pending_texts: List[str] = []
-    pending_indices: List[int] = []
-    newline_positions: List[Tuple[int, str]] = []
+T = TypeVar("T")
 
-    def flush_batch():
-        if not pending_texts:
+def _transcribe_stream(items: Iterable[Tuple[str, T]], window: Optional[int] = None, markers: bool = False) -> Iterator[Tuple[str, Optional[str], T]]:
+    """(text, ipa, tag) for every (text, tag), in order. Up to window (default _window_size()) texts are in flight, and each result is yielded as
+    soon as all the results before it are. With markers, print_ipa's "\n" markers pass through with no ipa"""
+    if rule_executor is not None:
+        yield from _transcribe_stream_pooled(items, markers)
+        return
+    pending: Deque[Tuple[str, T, Optional[str], object]] = deque()
+    # texts repeated inside the window (chapter headers, "Next Chapter" links...) share one transcription
+    in_flight: Dict[str, Tuple[Optional[str], object]] = {}
+
+    def finish_ready():
+        # the oldest text and every one after it that needs no waiting, so their rules run as one batch
+        ready = [pending.popleft()]
+        while pending and not (isinstance(pending[0][3], concurrent.futures.Future) and not pending[0][3].done()):
+            ready.append(pending.popleft())
+        for text, _, ipa, raw_ipa in ready:
+            if in_flight.get(text) == (ipa, raw_ipa) and not any(other[0] == text for other in pending):
+                del in_flight[text]
+        texts = [item for item in ready if not (markers and item[0] == "\n")]
+        finished = dict(zip((id(item) for item in texts), _finish_transcriptions([(text, ipa, raw_ipa) for text, _, ipa, raw_ipa in texts])))
+        for item in ready:
+            yield item[0], finished.get(id(item)), item[1]
+
+    for text, tag in items:
+        if markers and text == "\n":
+            pending.append((text, tag, None, None))
+        else:
+            if text not in in_flight:
+                in_flight[text] = _start_transcription(text)
+            pending.append((text, tag) + in_flight[text])
+        while len(pending) >= (window or _window_size()):
+            yield from finish_ready()
+    while pending:
+        yield from finish_ready()
+
+# --rule-processes: worker processes running flite and the rules on RULE_CHUNK_TEXTS texts per task. None runs them here
+rule_executor: Optional[ProcessPoolExecutor] = None
+rule_processes = 0
+RULE_CHUNK_TEXTS = 64
+
+def _transcribe_stream_pooled(items: Iterable[Tuple[str, T]], markers: bool) -> Iterator[Tuple[str, Optional[str], T]]:
+    """_transcribe_stream on rule_executor. Two chunks per process are in flight, so each has its next one waiting"""
+    pending: Deque[Tuple[List[Tuple[str, T]], "concurrent.futures.Future[Tuple[List[Optional[str]], Optional[Counter[str]]]]"]] = deque()
+
+    def submit(chunk: List[Tuple[str, T]]):
+        pending.append((chunk, rule_executor.submit(_transcribe_shard, [text for text, _ in chunk], markers)))
+
+    def finish_oldest():
+        chunk, future = pending.popleft()
+        ipas, stats = future.result()
+        if __debug__ and stats and rule_stats is not None:
+            _count_all(stats)
+        for (text, tag), ipa in zip(chunk, ipas):
+            yield text, ipa, tag
+
+    try:
+        for chunk in _chunked(items, RULE_CHUNK_TEXTS):
+            submit(chunk)
+            while len(pending) >= 2 * rule_processes or (pending and pending[0][1].done()):
+                yield from finish_oldest()
+        while pending:
+            yield from finish_oldest()
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+def _chunked(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
             return
-        batch_results = _run_flite_batch(pending_texts)
-        all_outputs = []
-        for pos_idx, marker in newline_positions:
-            all_outputs.append((pos_idx, marker, None))
-        for i, (orig, ipa) in enumerate(batch_results):
-            all_outputs.append((pending_indices[i], None, (orig, ipa)))
-        all_outputs.sort(key=lambda x: x[0])
-        for _, marker, result in all_outputs:
-            if marker is not None:
-                if out_file:
-                    out_file.write(marker)
-                else:
-                    print(marker, end='')
-            else:
-                orig, ipa = result
-                if out_file:
-                    out_file.write(ipa)
-                    out_file.write(orig)
-                else:
-                    print((orig, ipa))
-        if out_file:
-            out_file.flush()
-        pending_texts.clear()
-        pending_indices.clear()
-        newline_positions.clear()
+        yield chunk
 
-    order_counter = 0
-    for i, line in enumerate(lines):
-        if i < start_line:
+def _align_words(tokens: List[str], text: str, ipa_count: int) -> Optional["array[int]"]:
+    items = _double_word_plan([token.lower() for token in tokens], text, count=False) or range(len(tokens))
+    if len(items) != ipa_count:
+        return None
+    alignment = array('i', bytes(4 * len(tokens)))
+    word = 0
+    for ipa_index, item in enumerate(items):
+        if isinstance(item, str):
             continue
-        normalized_line = normalize(line)
-        if fix_line_ends:
-            normalized_line = fix_line_ending(normalized_line)
-            if normalized_line is None:
+        # words skipped since the last kept one were merged into the double word reduction before this item
+        while word < item:
+            alignment[word] = ipa_index - 1
+            word += 1
+        alignment[word] = ipa_index
+        word += 1
+    while word < len(tokens):
+        alignment[word] = len(items) - 1
+        word += 1
+    return alignment
+
+class Transcription:
+    """A transcribed text. tokens are its words and ipa_tokens the words of ipa, split on spaces like the rules split
+    them. alignment[i] is the ipa word of tokens[i], shared by both words of a double word reduction. alignment is
+    None when flite read the text as other words (numbers, abbreviations...). All three are worked out on first use,
+    writers that only need ipa don't pay for them"""
+    __slots__ = ("text", "ipa", "_tokens", "_ipa_tokens", "_alignment")
+
+    def __init__(self, text: str, ipa: str):
+        self.text = text
+        self.ipa = ipa
+        self._tokens: Optional[List[str]] = None
+        self._ipa_tokens: Optional[List[str]] = None
+        self._alignment: Union[None, bool, "array[int]"] = False
+
+    @property
+    def tokens(self) -> List[str]:
+        if self._tokens is None:
+            self._tokens = self.text.split(" ")
+        return self._tokens
+
+    @property
+    def ipa_tokens(self) -> List[str]:
+        if self._ipa_tokens is None:
+            self._ipa_tokens = self.ipa.split(" ")
+        return self._ipa_tokens
+
+    @property
+    def alignment(self) -> Optional["array[int]"]:
+        # False until worked out, it can be None
+        if self._alignment is False:
+            self._alignment = _align_words(self.tokens, self.text, len(self.ipa_tokens))
+        return self._alignment
+
+    def __repr__(self):
+        return f"Transcription({self.text!r}, {self.ipa!r})"
+
+def transcribe_stream(items: Iterable[Tuple[str, T]], window: Optional[int] = None) -> Iterator[Tuple[str, Transcription, T]]:
+    """(text, transcription, tag) for every (text, tag), in order and as soon as ready"""
+    for text, ipa, tag in _transcribe_stream(items, window):
+        yield text, Transcription(text, ipa), tag
+
+def transcribe_batch(texts: List[str]) -> List[Transcription]:
+    results = [transcription for _, transcription, _ in transcribe_stream(((text, None) for text in texts), max(1, len(texts)))]
+    _flush_caches()
+    return results
+
+def transcribe(text: str) -> Transcription:
+    return transcribe_batch([text])[0]
+
+def _write_ipa(out_file: Optional[TextIOWrapper], orig: str, ipa: Optional[str]):
+    if ipa is None:
+        if out_file:
+            out_file.write(orig)
+        else:
+            print(orig, end='')
+    elif out_file:
+        out_file.write(ipa)
+        out_file.write(orig)
+    else:
+        print((orig, ipa))
+
+def print_ipa(out_file: Optional[TextIOWrapper], lines: Iterable[str], fix_line_ends: bool = True, checkpoint_path: Optional[str] = None, start_line: int = 0,
+              vocab_prepass: bool = False, joiner: Optional[LineJoiner] = None):
+    """lines can be any iterable (an open file, sys.stdin...). It is read as the output is written, so only the
+    in flight window is held in memory. vocab_prepass needs all the lines first and reads them into a list.
+    joiner is the line joining state to resume from, a new one by default"""
+    joiner = joiner or LineJoiner()
+    if vocab_prepass:
+        lines = list(lines)
+        document_state.vocab_lexicon = build_vocabulary_lexicon([normalize(line) for line in lines[start_line:]])
+    total = start_line
+
+    def read_texts():
+        """Every text to transcribe, tagged with the checkpoint to save once it is written"""
+        nonlocal total
+        for i, line in enumerate(lines):
+            total = i + 1
+            if i < start_line:
                 continue
-        if normalized_line == "\n":
-            newline_positions.append((order_counter, normalized_line))
-            order_counter += 1
+            normalized_line = normalize(line)
+            if fix_line_ends:
+                normalized_line = joiner.fix_line_ending(normalized_line)
+                if normalized_line is None:
+                    continue
+            yield normalized_line, dict(joiner.snapshot(), lines_processed=i + 1)
+        rest = joiner.flush()
+        if rest is not None:
+            yield rest, dict(joiner.snapshot(), lines_processed=total)
+
+    written = 0
+    for orig, ipa, checkpoint in _transcribe_stream(read_texts(), markers=True):
+        _write_ipa(out_file, orig, ipa)
+        if ipa is None:
             continue
-        pending_texts.append(normalized_line)
-        pending_indices.append(order_counter)
-        order_counter += 1
-        if len(pending_texts) >= FLITE_BATCH_SIZE:
-            flush_batch()
+        written += 1
+        if written % FLITE_BATCH_SIZE == 0 and out_file:
+            out_file.flush()
             if checkpoint_path:
-                save_checkpoint(checkpoint_path, {
-                    "lines_processed": i + 1,
-                    "output_bytes": out_file.tell() if out_file else 0,
-                    "cached_text": cached_text,
-                    "line_end_count": line_end_count,
-                    "is_chapter": is_chapter
-                })
-    if cached_text != "":
-        pending_texts.append(cached_text)
-        pending_indices.append(order_counter)
-        order_counter += 1
-    flush_batch()
+                _flush_caches()
+                save_checkpoint(checkpoint_path, dict(checkpoint, output_bytes=out_file.tell()))
+    if out_file:
+        out_file.flush()
+    _flush_caches()
+    document_state.vocab_lexicon = None
     if checkpoint_path:
-        save_checkpoint(checkpoint_path, {
-            "lines_processed": total,
-            "output_bytes": out_file.tell() if out_file else 0,
-            "cached_text": "",
-            "line_end_count": 0,
-            "is_chapter": False
-        })
+        save_checkpoint(checkpoint_path, dict(LineJoiner().snapshot(), lines_processed=total, output_bytes=out_file.tell() if out_file else 0))
+
+# A chapter longer than this is split, so a book without headings still spreads over the workers
+CHAPTER_SHARD_MAX_CHARS = 100_000
+
+def chapter_shards(lines: Iterable[str], fix_line_ends: bool = True) -> Iterator[List[str]]:
+    """The texts print_ipa transcribes for lines, cut before every PROLOGUE/CHAPTER/EPILOGUE heading. Lines are joined
+    here, in order, so the shards can be transcribed anywhere and still give print_ipa's output"""
+    joiner = LineJoiner()
+    shard: List[str] = []
+    size = 0
+    for line in lines:
+        text = normalize(line)
+        if fix_line_ends:
+            text = joiner.fix_line_ending(text)
+            if text is None:
+                continue
+        # the joiner starts a heading's text with "\n"
+        if shard and (size >= CHAPTER_SHARD_MAX_CHARS or (text[:1] == "\n" and text.split()[:1] and text.split()[0] in CHAPTER_HEADINGS)):
+            yield shard
+            shard, size = [], 0
+        shard.append(text)
+        size += len(text)
+    rest = joiner.flush()
+    if rest is not None:
+        shard.append(rest)
+    if shard:
+        yield shard
+
+def worker_settings(rule_packs: List[str], lexicon_packs: List[str], processes: int) -> Dict[str, object]:
+    """What _init_worker needs to set a worker process up like this one. The flite budget is split between the processes"""
+    return {"verb_backend": verb_backend, "nltk_offline": nltk_offline,
+            "jobs": max(1, -(-FLITE_MAX_WORKERS // processes)), "batch_size": None if adaptive_window is not None else FLITE_BATCH_SIZE,
+            "rule_packs": rule_packs, "lexicon_packs": lexicon_packs, "rule_stats": rule_stats is not None}
+
+def preload_rules():
+    """Builds what the rule stages otherwise build on first use: the improved pronunciation matcher, the numpy t/d
+    tables, and for --verb-backend nltk the tokenizer and tagger models"""
+    _improved_matcher()
+    if _numpy() is not None:
+        _get_td_tables()
+    if verb_backend == "nltk":
+        pos_tag_sents([word_tokenize("They could have gone.")])
+
+def _init_worker(settings: Dict[str, object]):
+    global verb_backend, nltk_offline, FLITE_MAX_WORKERS, FLITE_BATCH_SIZE, adaptive_window, rule_stats, word_cache, result_cache
+    global rule_executor
+    # a forked worker inherits these. The caches' sqlite connections stay with the parent, and a worker runs its tasks itself
+    word_cache = result_cache = None
+    rule_executor = None
+    verb_backend = settings["verb_backend"]
+    nltk_offline = settings["nltk_offline"]
+    FLITE_MAX_WORKERS = settings["jobs"]
+    if settings["batch_size"] is None:
+        adaptive_window = AdaptiveWindow(FLITE_MAX_WORKERS)
+    else:
+        FLITE_BATCH_SIZE = settings["batch_size"]
+    if settings["rule_packs"]:
+        use_rule_packs(settings["rule_packs"])
+    if settings["lexicon_packs"]:
+        use_lexicon_packs(settings["lexicon_packs"])
+    rule_stats = Counter() if settings["rule_stats"] else None
+    preload_rules()
+
+def start_rule_workers(processes: int, settings: Dict[str, object]) -> ProcessPoolExecutor:
+    """A ProcessPoolExecutor of processes workers set up with settings, all of them started before it returns. A worker
+    forked later, from a document thread while the flite driver runs, could inherit a lock another thread holds"""
+    executor = ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(settings,))
+    # forked workers all start on the first submit, the others as tasks wait
+    for future in [executor.submit(os.getpid) for _ in range(processes)]:
+        future.result()
+    return executor
+
+def _transcribe_shard(texts: List[str], markers: bool = True) -> Tuple[List[Optional[str]], Optional["Counter[str]"]]:
+    """ipa for every text of a shard (None for "\n" markers), and the rule hits it took"""
+    ipas = [ipa for _, ipa, _ in _transcribe_stream(((text, None) for text in texts), markers=markers)]
+    stats = None
+    if __debug__ and rule_stats is not None:
+        with _rule_stats_lock:
+            stats = rule_stats.copy()
+            rule_stats.clear()
+    return ipas, stats
+
+def print_ipa_sharded(out_file: Optional[TextIOWrapper], lines: Iterable[str], executor: concurrent.futures.Executor, in_flight: int,
+                      fix_line_ends: bool = True, checkpoint_path: Optional[str] = None, start_shard: int = 0):
+    """print_ipa's output, with the chapters transcribed on executor. Up to in_flight chapters are submitted at once,
+    and each one is written as soon as the ones before it are"""
+    pending: Deque[Tuple[List[str], "concurrent.futures.Future[Tuple[List[Optional[str]], Optional[Counter[str]]]]"]] = deque()
+    shards_written = start_shard
+
+    def write_oldest():
+        nonlocal shards_written
+        texts, future = pending.popleft()
+        ipas, stats = future.result()
+        for text, ipa in zip(texts, ipas):
+            _write_ipa(out_file, text, ipa)
+        if __debug__ and stats and rule_stats is not None:
+            _count_all(stats)
+        shards_written += 1
+        if out_file:
+            out_file.flush()
+            if checkpoint_path:
+                save_checkpoint(checkpoint_path, {"shards_processed": shards_written, "output_bytes": out_file.tell()})
+
+    try:
+        for texts in itertools.islice(chapter_shards(lines, fix_line_ends), start_shard, None):
+            pending.append((texts, executor.submit(_transcribe_shard, texts)))
+            while len(pending) >= in_flight or (pending and pending[0][1].done()):
+                write_oldest()
+        while pending:
+            write_oldest()
+    finally:
+        for _, future in pending:
+            future.cancel()
 
 PARAGRAPH_PATTERN = re.compile(r'(<p\b[^>]*>)(.*?)(</p>)', re.DOTALL | re.IGNORECASE)
 TAG_PATTERN = re.compile(r'<[^>]*>')
@@ -556,13 +2171,10 @@ def _assemble_paragraph(prep_data, flite_results, paragraph_count, counter):
 
 def _process_single_paragraph(match: re.Match, paragraph_count: int, counter: int) -> str:
     prep_data, normalized_texts = _prepare_paragraph_texts(match)
-    flite_results = []
-    for text in normalized_texts:
-        _, ipa = run_flite(text)
-        flite_results.append(ipa)
+    flite_results = [transcription.ipa for transcription in transcribe_batch(normalized_texts)]
     return _assemble_paragraph(prep_data, flite_results, paragraph_count, counter)
 
-def process_html_file(input_path: str, output_path: Optional[str], resume: bool = False):
+def process_html_file(input_path: str, output_path: Optional[str], resume: bool = False, vocab_prepass: bool = False):
     with open(input_path, 'r', encoding='utf-8') as f:
         content = f.read()
 
@@ -590,9 +2202,14 @@ def process_html_file(input_path: str, output_path: Optional[str], resume: bool
     else:
         out_file = sys.stdout
     prev_end = matches[start_paragraph - 1].end() if start_paragraph > 0 else 0
-
-    for batch_start in range(start_paragraph, len(matches), FLITE_BATCH_SIZE):
-        batch_end = min(batch_start + FLITE_BATCH_SIZE, len(matches))
+    if vocab_prepass:
+        document_state.vocab_lexicon = build_vocabulary_lexicon([text for match in matches[start_paragraph:]
+                                                  for text in _prepare_paragraph_texts(match)[1]])
+
+    batch_end = start_paragraph
+    while batch_end < len(matches):
+        batch_start = batch_end
+        batch_end = min(batch_start + _window_size(), len(matches))
         batch_prep = []
         all_normalized = []
         text_counts = []
@@ -601,15 +2218,7 @@ def process_html_file(input_path: str, output_path: Optional[str], resume: bool
             batch_prep.append((idx, prep_data))
             all_normalized.extend(normalized_texts)
             text_counts.append(len(normalized_texts))
-        with ThreadPoolExecutor(max_workers=FLITE_MAX_WORKERS) as executor:
-            all_ipa_raw = list(executor.map(_call_flite, all_normalized))
-        all_flite_results = []
-        for raw_ipa, normalized in zip(all_ipa_raw, all_normalized):
-            ipa = add_reductions_with_stress(raw_ipa, normalized)
-            ipa = add_double_word_reductions(ipa, normalized)
-            ipa = handle_t_d(ipa)
-            ipa = ipa.replace("ˈ", "")
-            all_flite_results.append(ipa)
+        all_flite_results = [transcription.ipa for transcription in transcribe_batch(all_normalized)]
         result_offset = 0
         for (idx, prep_data), count in zip(batch_prep, text_counts):
             flite_results = all_flite_results[result_offset:result_offset + count]
@@ -625,6 +2234,7 @@ def process_html_file(input_path: str, output_path: Optional[str], resume: bool
                 "output_bytes": out_file.tell()
             })
 
+    document_state.vocab_lexicon = None
     out_file.write(content[prev_end:])
     out_file.flush()
     if output_path:
@@ -632,10 +2242,19 @@ def process_html_file(input_path: str, output_path: Optional[str], resume: bool
     if checkpoint_path:
         remove_checkpoint(checkpoint_path)
 
+def write_rule_stats(path: str):
+    """rule_stats as JSON: hits per rule ("normal:for", "double:do you", "verb_rejected:going to", "improved:fæməli",
+    "flap"...), and the improved_pronounciations entries that never fired"""
+    counts = dict(sorted(rule_stats.items(), key=lambda item: (-item[1], item[0])))
+    unused = [orig for orig in improved_pronounciations if "improved:" + orig not in rule_stats]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"counts": counts, "unused_improved_pronounciations": unused}, f, ensure_ascii=False, indent=1)
+
 def main():
-    global cached_text, line_end_count, is_chapter
+    global verb_backend, nltk_offline, word_cache, result_cache
+    global FLITE_MAX_WORKERS, FLITE_BATCH_SIZE, adaptive_window, rule_stats, rule_executor, rule_processes
     parser = argparse.ArgumentParser()
-    parser.add_argument("data", type=str, help="Input text or filename")
+    parser.add_argument("data", type=str, help="Input text or filename. - reads the text from stdin")
     parser.add_argument("-f", "--file", action="store_true",
                         help="Indicate that the input is a filename/dirname instead of text. If dir, will translate all the files in that dir. In this case, output must be given, and be a directory")
     parser.add_argument("-o", "--output", type=str, nargs='?', default=None, help="Optional output file/directory. If not given, will print to stdout")
@@ -643,70 +2262,216 @@ def main():
                         help="Process an HTML file, running flite only on text content while preserving HTML tags. Decodes HTML entities before processing.")
     parser.add_argument("-r", "--resume", action="store_true",
                         help="Resume from the last checkpoint. Requires --output to be set")
+    parser.add_argument("-j", "--jobs", type=str, default="auto",
+                        help="Number of flite calls to run at once. auto (default) uses the CPUs this process may use, cgroup quota included")
+    parser.add_argument("--parallel-files", type=int, default=None, metavar="N",
+                        help="With a directory input, transcribe up to N files at once, largest first. They share the --jobs flite budget. Defaults to --jobs")
+    parser.add_argument("--chapter-shards", type=int, default=None, metavar="PROCESSES",
+                        help="Split a text input at its PROLOGUE/CHAPTER/EPILOGUE headings and transcribe the chapters on this many processes. Same output as without it")
+    parser.add_argument("--rule-processes", type=int, default=None, metavar="N",
+                        help="Run flite and the pronunciation rules on N worker processes, in chunks of texts, instead of on this process's one core")
+    parser.add_argument("--batch-size", type=str, default="auto",
+                        help="Number of lines/paragraphs in flight at once. auto (default) adapts it to flite's latency while running")
+    parser.add_argument("--rules", action="append", default=[], metavar="PACK",
+                        help="JSON rule pack layered over the built in rule tables (e.g. fixes for one book). Can be given more than once, later packs win")
+    parser.add_argument("--lexicon", action="append", default=[], metavar="PACK",
+                        help="JSON lexicon pack with proper noun fixes for a book/series: word pronunciations, IPA rewrites and t/d skip words. Can be given more than once")
+    parser.add_argument("--verb-backend", choices=VERB_BACKENDS, default="lexicon",
+                        help="How to tell if the word after could/should/would have or going to is a verb: built in verb lexicon (fast), or the NLTK tagger")
+    parser.add_argument("--nltk-offline", action="store_true",
+                        help="Never download NLTK data. --verb-backend nltk fails at once if it isn't installed")
+    parser.add_argument("--rule-stats", type=str, default=None, metavar="JSON",
+                        help="Write how often every rule fired, and the improved pronunciations that never did, to this file. Lines served by --result-cache aren't counted")
+    parser.add_argument("--word-cache", type=str, default=None,
+                        help="sqlite file caching flite's pronunciation of every word. Shared between runs and books, flite only runs on lines with new words")
+    parser.add_argument("--word-cache-size", type=int, default=WORD_CACHE_MAX_ENTRIES,
+                        help="Maximal number of words in --word-cache. Least recently used words are evicted")
+    parser.add_argument("--result-cache", type=str, default=None,
+                        help="sqlite file caching the final transcription of every line/paragraph. Invalidated when the rules or flite change")
+    parser.add_argument("--prune-result-cache", action="store_true",
+                        help="Drop the --result-cache entries made with other rules or another flite first. Leave it off when other setups share the file")
+    parser.add_argument("--vocab-prepass", action="store_true",
+                        help="Pronounce the input's unique words in a few large flite calls first, and build the lines from them. Only lines with numbers, abbreviations and such run flite on their own")
 
     # Parse the arguments
     args = parser.parse_args()
 
     if args.resume and not args.output:
         parser.error("--resume requires --output to be set")
-
-    if args.html:
-        process_html_file(args.data, args.output, args.resume)
-        return
-    out_file = None
-    if args.file:
-        if os.path.isfile(args.data):
-            lines = open(args.data).readlines()
+    if args.html and args.data == "-":
+        parser.error("--html needs an input file, not stdin")
+    if args.chapter_shards is not None:
+        if args.chapter_shards < 1:
+            parser.error("--chapter-shards takes a number of processes")
+        if args.html or (args.file and os.path.isdir(args.data)):
+            parser.error("--chapter-shards doesn't work with --html or a directory input")
+    if args.rule_processes is not None and args.rule_processes < 1:
+        parser.error("--rule-processes takes a number of processes")
+    if args.chapter_shards is not None and args.rule_processes is not None:
+        parser.error("--chapter-shards already runs the rules on its processes, --rule-processes can't be added")
+    if (args.chapter_shards is not None or args.rule_processes is not None) and (args.word_cache or args.result_cache or args.vocab_prepass):
+        parser.error("--word-cache, --result-cache and --vocab-prepass only work in process, not with --chapter-shards or --rule-processes")
+
+    verb_backend = args.verb_backend
+    nltk_offline = args.nltk_offline
+    try:
+        if args.jobs != "auto":
+            FLITE_MAX_WORKERS = max(1, int(args.jobs))
+        if args.batch_size != "auto":
+            FLITE_BATCH_SIZE = max(1, int(args.batch_size))
+    except ValueError:
+        parser.error("--jobs and --batch-size take a number or auto")
+    if args.batch_size == "auto":
+        adaptive_window = AdaptiveWindow(FLITE_MAX_WORKERS)
+    if args.rules:
+        try:
+            use_rule_packs(args.rules)
+        except (OSError, ValueError) as e:
+            parser.error(f"--rules: {e}")
+    if args.lexicon:
+        try:
+            use_lexicon_packs(args.lexicon)
+        except (OSError, ValueError) as e:
+            parser.error(f"--lexicon: {e}")
+    if args.rule_stats:
+        if __debug__:
+            rule_stats = Counter()
         else:
-            assert args.output, "When directory is given, output must also be a directory"
-            checkpoint_path = get_checkpoint_path(args.output)
-            completed_files = set()
-            if args.resume:
-                checkpoint = load_checkpoint(checkpoint_path)
-                completed_files = set(checkpoint.get("completed_files", []))
-                if completed_files:
-                    print(f"Resuming: skipping {len(completed_files)} already completed files")
-
-            for root, folders, files in os.walk(args.data):
-                for file_name in files:
-                    input_path = os.path.join(root, file_name)
-                    if input_path in completed_files:
-                        continue
-                    with open(input_path) as f:
-                        lines = f.readlines()
-                    out_file_name = "ipa_" + file_name
-                    with open(os.path.join(args.output, out_file_name), "w") as o:
-                        print_ipa(o, lines)
-                    completed_files.add(input_path)
-                    save_checkpoint(checkpoint_path, {"completed_files": list(completed_files)})
-
-            remove_checkpoint(checkpoint_path)
-            return
+            logging.warning('rule stats are compiled out under python -O, --rule-stats ignored.')
+    if args.word_cache:
+        word_cache = WordCache(args.word_cache, args.word_cache_size)
+    if args.result_cache:
+        result_cache = ResultCache(args.result_cache)
+        if args.prune_result_cache:
+            print(f"result cache: pruned {result_cache.prune()} entries", file=sys.stderr)
+    if args.rule_processes is not None:
+        rule_processes = args.rule_processes
+        rule_executor = start_rule_workers(rule_processes, worker_settings(args.rules, args.lexicon, rule_processes))
+    try:
+        _run(args)
+    finally:
+        if rule_executor is not None:
+            rule_executor.shutdown()
+        if word_cache is not None:
+            print(f"word cache: {word_cache.stats()}", file=sys.stderr)
+            word_cache.close()
+        if result_cache is not None:
+            print(f"result cache: {result_cache.stats()}", file=sys.stderr)
+            result_cache.close()
+        if _flite_driver is not None:
+            print(f"flite: {_flite_driver.stats()}", file=sys.stderr)
+        if rule_stats is not None:
+            write_rule_stats(args.rule_stats)
+
+def _run(args):
+    if args.html:
+        process_html_file(args.data, args.output, args.resume, args.vocab_prepass)
+    elif args.data == "-":
+        _print_ipa_to_output(args, sys.stdin)
+    elif not args.file:
+        _print_ipa_to_output(args, args.data.split("\n"))
+    elif os.path.isfile(args.data):
+        with open(args.data) as f:
+            _print_ipa_to_output(args, f)
     else:
-        lines = args.data.split("\n")
+        assert args.output, "When directory is given, output must also be a directory"
+        _transcribe_directory(args.data, args.output, args.resume, args.vocab_prepass, args.parallel_files)
 
+def _transcribe_file(input_path: str, output_path: str, vocab_prepass: bool):
+    global open_documents
+    with _open_documents_lock:
+        open_documents += 1
+    try:
+        with open(input_path) as f, open(output_path, "w") as o:
+            print_ipa(o, f, vocab_prepass=vocab_prepass)
+    finally:
+        with _open_documents_lock:
+            open_documents -= 1
+
+def _directory_output_path(input_dir: str, output_dir: str, input_path: str) -> str:
+    """output_dir/<subdirectory>/ipa_<name> for input_dir/<subdirectory>/<name>, so files of the same name in different
+    subdirectories don't overwrite each other. Creates the subdirectory"""
+    folder, name = os.path.split(os.path.relpath(input_path, input_dir))
+    os.makedirs(os.path.join(output_dir, folder), exist_ok=True)
+    return os.path.join(output_dir, folder, "ipa_" + name)
+
+def _transcribe_directory(input_dir: str, output_dir: str, resume: bool = False, vocab_prepass: bool = False, at_once: Optional[int] = None):
+    """Transcribes every file under input_dir to output_dir/<subdirectory>/ipa_<name>, at_once (default FLITE_MAX_WORKERS) files at a
+    time, largest first. They share the flite driver and the window, so more files don't mean more flite processes"""
+    checkpoint_path = get_checkpoint_path(output_dir)
+    completed_files = set()
+    if resume:
+        checkpoint = load_checkpoint(checkpoint_path)
+        completed_files = set(checkpoint.get("completed_files", []))
+        if completed_files:
+            print(f"Resuming: skipping {len(completed_files)} already completed files")
+
+    input_paths = [os.path.join(root, file_name) for root, folders, files in os.walk(input_dir) for file_name in files]
+    # the largest book takes the longest, start it first so it doesn't run alone at the end
+    input_paths = sorted((path for path in input_paths if path not in completed_files), key=os.path.getsize, reverse=True)
+    with ThreadPoolExecutor(max_workers=max(1, min(at_once or FLITE_MAX_WORKERS, len(input_paths))), thread_name_prefix="document") as executor:
+        futures = {executor.submit(_transcribe_file, path, _directory_output_path(input_dir, output_dir, path), vocab_prepass): path
+                   for path in input_paths}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                completed_files.add(futures[future])
+                save_checkpoint(checkpoint_path, {"completed_files": list(completed_files)})
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    remove_checkpoint(checkpoint_path)
+
+def _print_ipa_sharded_to_output(args, lines: Iterable[str]):
+    checkpoint_path = get_checkpoint_path(args.output) if args.output is not None else None
+    start_shard = 0
+    if args.resume:
+        checkpoint = load_checkpoint(checkpoint_path)
+        start_shard = checkpoint.get("shards_processed", 0)
+        output_bytes = checkpoint.get("output_bytes", 0)
+        if start_shard > 0:
+            print(f"Resuming from chapter shard {start_shard}")
+            if os.path.exists(args.output):
+                with open(args.output, "r+b") as f:
+                    f.truncate(output_bytes)
+    out_file = open(args.output, "a" if start_shard > 0 else "w") if args.output is not None else None
+    settings = worker_settings(args.rules, args.lexicon, args.chapter_shards)
+    try:
+        with start_rule_workers(args.chapter_shards, settings) as executor:
+            print_ipa_sharded(out_file, lines, executor, 2 * args.chapter_shards, checkpoint_path=checkpoint_path, start_shard=start_shard)
+    finally:
+        if out_file:
+            out_file.close()
+    if checkpoint_path:
+        remove_checkpoint(checkpoint_path)
+
+def _print_ipa_to_output(args, lines: Iterable[str]):
+    if args.chapter_shards is not None:
+        _print_ipa_sharded_to_output(args, lines)
+        return
     if args.output is not None:
         checkpoint_path = get_checkpoint_path(args.output)
         start_line = 0
+        joiner = LineJoiner()
         if args.resume:
             checkpoint = load_checkpoint(checkpoint_path)
             start_line = checkpoint.get("lines_processed", 0)
             output_bytes = checkpoint.get("output_bytes", 0)
             if start_line > 0:
                 print(f"Resuming from line {start_line}")
-                cached_text = checkpoint.get("cached_text", "")
-                line_end_count = checkpoint.get("line_end_count", 0)
-                is_chapter = checkpoint.get("is_chapter", False)
+                joiner = LineJoiner.restore(checkpoint)
                 if output_bytes > 0 and os.path.exists(args.output):
                     with open(args.output, "r+b") as f:
                         f.truncate(output_bytes)
         mode = "a" if start_line > 0 else "w"
         out_file = open(args.output, mode)
-        print_ipa(out_file, lines, checkpoint_path=checkpoint_path, start_line=start_line)
+        print_ipa(out_file, lines, checkpoint_path=checkpoint_path, start_line=start_line, vocab_prepass=args.vocab_prepass, joiner=joiner)
         out_file.close()
         remove_checkpoint(checkpoint_path)
     else:
-        print_ipa(None, lines)
+        print_ipa(None, lines, vocab_prepass=args.vocab_prepass)
 
 if __name__ == "__main__":
     main()
@@ -1,8 +1,10 @@
+import inspect
 import json
 import os
 import re
 import subprocess
 import tempfile
+import time
 
 import pytest
 
@@ -15,7 +17,6 @@ from main import (
     add_double_word_reductions,
     fix_nn,
     fix_numbers,
-    fix_line_ending,
     get_checkpoint_path,
     load_checkpoint,
     save_checkpoint,
@@ -208,38 +209,52 @@ class TestFixNumbers:
 class TestFixLineEnding:
     def setup_method(self):
         import main
-        main.cached_text = ""
-        main.line_end_count = 0
-        main.is_chapter = False
+        self.joiner = main.LineJoiner()
+        self.fix_line_ending = self.joiner.fix_line_ending
 
     def test_complete_sentence_returned(self):
-        result = fix_line_ending("Hello world.\n")
+        result = self.fix_line_ending("Hello world.\n")
         assert result is not None
         assert "Hello world." in result
 
     def test_incomplete_line_cached(self):
-        result = fix_line_ending("Hello world")
+        result = self.fix_line_ending("Hello world")
         assert result is None
 
     def test_cached_line_flushed_on_complete(self):
-        fix_line_ending("Hello")
-        result = fix_line_ending(" world.\n")
+        self.fix_line_ending("Hello")
+        result = self.fix_line_ending(" world.\n")
         assert result is not None
         assert "Hello" in result
 
     def test_single_newline_returned_first_time(self):
-        result = fix_line_ending("\n")
+        result = self.fix_line_ending("\n")
         assert result == "\n"
 
     def test_consecutive_newlines_skipped(self):
-        fix_line_ending("\n")
-        result = fix_line_ending("\n")
+        self.fix_line_ending("\n")
+        result = self.fix_line_ending("\n")
         assert result is None
 
     def test_chapter_handling(self):
-        result = fix_line_ending("CHAPTER\n")
+        result = self.fix_line_ending("CHAPTER\n")
         assert result is None
 
+    def test_snapshot_restores_state(self):
+        import main
+        self.fix_line_ending("CHAPTER\n")
+        self.fix_line_ending("The Dark")
+        restored = main.LineJoiner.restore(self.joiner.snapshot())
+        assert restored.snapshot() == self.joiner.snapshot()
+        assert restored.fix_line_ending("One.\n") == self.fix_line_ending("One.\n")
+
+    def test_joiners_are_independent(self):
+        import main
+        other = main.LineJoiner()
+        self.fix_line_ending("Hello")
+        assert other.fix_line_ending("World.\n") == "World.\n"
+        assert self.fix_line_ending(" there.\n") == "Hello  there.\n"
+
 
 class TestCheckpointing:
     def test_get_checkpoint_path_file(self):
@@ -310,6 +325,14 @@ class TestIsVerbInSentence:
     def test_word_not_found(self):
         assert is_verb_in_sentence("xyz", "The dog barked") is False
 
+    def test_lexicon_backend(self):
+        import main
+        assert main.verb_backend == "lexicon"
+        for word in ("been", "done", "be", "wagered", "realize", "gone.", "Killed,"):
+            assert main.is_verb_word(word), word
+        for word in ("the", "a", "her", "bed", "caemlyn", "more", "to"):
+            assert not main.is_verb_word(word), word
+
 
 class TestConstants:
     def test_ipa_letters_is_combined(self):
@@ -519,3 +542,1131 @@ class TestProcessHtmlFileIntegration:
         assert len(captured.out) > 0
         found_ipa = any(ch in IPA_CHARS for ch in captured.out)
         assert found_ipa
+
+
+def flite_ipa(text):
+    # like flite -i: words joined by single spaces, the trailing white space kept, plus a new line
+    return " ".join(text.lower().split()) + text[len(text.rstrip()):] + "\n"
+
+
+FAKE_FLITE_SOURCE = "import sys\n\n" + inspect.getsource(flite_ipa) + '''
+text = sys.argv[sys.argv.index("-t") + 1]
+sys.stdout.write(flite_ipa(text))
+'''
+
+
+@pytest.fixture
+def fake_flite(tmp_path, monkeypatch):
+    """Points main at a tiny python stand-in for flite that lower cases its input"""
+    import sys
+    import main
+    script = tmp_path / "flite"
+    script.write_text(f"#!{sys.executable}\n" + FAKE_FLITE_SOURCE, encoding="utf-8")
+    script.chmod(0o755)
+    monkeypatch.setattr(main, "_flite_path", str(script))
+    return str(script)
+
+
+def batch(texts):
+    """(text, ipa) pairs from the library API"""
+    import main
+    return [(transcription.text, transcription.ipa) for transcription in main.transcribe_batch(texts)]
+
+
+def record_flite_calls(monkeypatch, calls):
+    """Appends every text sent to flite, by the sync and the async callers, to calls"""
+    import main
+    real_call, real_call_async = main._call_flite, main._call_flite_async
+
+    async def call_async(text):
+        calls.append(text)
+        return await real_call_async(text)
+    monkeypatch.setattr(main, "_call_flite", lambda text: calls.append(text) or real_call(text))
+    monkeypatch.setattr(main, "_call_flite_async", call_async)
+
+
+def stub_flite(monkeypatch, func):
+    """Replaces flite itself with func, for the sync and the async callers"""
+    import main
+
+    async def call_async(text):
+        return func(text)
+    monkeypatch.setattr(main, "_call_flite", func)
+    monkeypatch.setattr(main, "_call_flite_async", call_async)
+
+
+def write_pack(path, pack):
+    """Writes a rule or lexicon pack, returns its path"""
+    path.write_text(json.dumps(pack, ensure_ascii=False), encoding="utf-8")
+    return str(path)
+
+
+class TestCallFlite:
+    def test_runs_flite_per_text(self, fake_flite):
+        import main
+        assert main._call_flite("Hello World") == "hello world\n"
+
+    def test_missing_flite_gives_empty_output(self, tmp_path, monkeypatch):
+        import main
+        monkeypatch.setattr(main, "_flite_path", str(tmp_path / "missing"))
+        assert main._call_flite("Hello") == ""
+
+
+class TestWordCache:
+    def test_split_word_token(self):
+        from main import _split_word_token
+        assert _split_word_token('"Hello,') == ('"', "Hello", ",")
+        assert _split_word_token("-") == ("-", "", "")
+        assert _split_word_token("it's") == ("", "it's", "")
+
+    def test_assemble_from_words(self):
+        from main import _assemble_from_words
+        lexicon = {"the V": "ði", "eye": "aɪ"}
+        assert _assemble_from_words('"The Eye."\n', lexicon) == '"ði aɪ."\n\n'
+        assert _assemble_from_words("The Dragon\n", lexicon) is None
+        assert _assemble_from_words("The 2 eye\n", lexicon) is None
+        assert _assemble_from_words("The eye Mr. Eye\n", lexicon) is None
+        assert _assemble_from_words("The eye read\n", {"read": "ɹɛd", **lexicon}) is None
+
+    def test_harvest_round_trip(self):
+        from main import _harvest_words
+        words = _harvest_words('"The Eye - the eye."\n', '"ði aɪ - ði aɪ."\n\n')
+        assert words == {"the V": "ði", "eye": "aɪ"}
+
+    def test_harvest_rejects_misaligned_output(self):
+        from main import _harvest_words
+        assert _harvest_words("Chapter 12\n", "tʃæptɝ twɛlv\n\n") == {"chapter": "tʃæptɝ"}
+        assert _harvest_words("Chapter 12\n", "tʃæptɝ twɛlv θɝ\n\n") == {}
+        assert _harvest_words("a b\n", "eɪ bi si\n\n") == {}
+        assert _harvest_words("the the\n", "ðə ði\n\n") == {"the C": "ðə", "the ": "ði"}
+        assert _harvest_words("the the the\n", "ðə ði ði\n\n") == {}
+
+    def test_harvested_words_rebuild_other_lines_by_next_sound(self):
+        from main import _assemble_from_words, _harvest_words
+        lexicon = _harvest_words("The eye was the best.\n", "ði aɪ wʌz ðə bɛst.\n\n")
+        lexicon.update(_harvest_words("A cat\n", "eɪ kæt\n\n"))
+        assert _assemble_from_words("The best eye.\n", lexicon) == "ðə bɛst aɪ.\n\n"
+        assert _assemble_from_words("the eye was best\n", lexicon) == "ði aɪ wʌz bɛst\n\n"
+        # no pronunciation of "the" before a word's end, nor of the lower case "a"
+        assert _assemble_from_words("was the\n", lexicon) is None
+        assert _assemble_from_words("a cat\n", lexicon) is None
+
+    def test_cache_persists_and_counts(self, tmp_path):
+        from main import WordCache
+        path = str(tmp_path / "words.sqlite")
+        cache = WordCache(path)
+        cache.put_many({"eye": "aɪ"})
+        cache.close()
+        cache = WordCache(path)
+        found = cache.get_many(["eye", "dragon"])
+        cache.count(len(found), 1)
+        assert found == {"eye": "aɪ"}
+        stats = cache.stats()
+        assert stats["hits"] == 1 and stats["misses"] == 1 and stats["entries"] == 1
+        cache.close()
+
+    def test_lru_eviction(self, tmp_path):
+        from main import WordCache
+        cache = WordCache(str(tmp_path / "words.sqlite"), max_entries=2)
+        cache.put_many({"a": "eɪ"})
+        cache.put_many({"b": "bi"})
+        cache.get_many(["a"])
+        cache.put_many({"c": "si"})
+        cache.flush()
+        assert set(cache.get_many(["a", "b", "c"])) == {"a", "c"}
+        cache.close()
+
+    def test_batch_only_calls_flite_for_new_words(self, tmp_path, fake_flite, monkeypatch):
+        import main
+        calls = []
+        record_flite_calls(monkeypatch, calls)
+        monkeypatch.setattr(main, "word_cache", main.WordCache(str(tmp_path / "words.sqlite")))
+        first = batch(["The Eye.\n", "Eye the\n"])
+        second = batch(["Eye.\n", "The eye, the\n", "New word\n"])
+        assert [ipa for _, ipa in first] == ["the eye.\n\n", "eye the\n\n"]
+        assert [ipa for _, ipa in second] == ["eye.\n\n", "the eye, the\n\n", "new word\n\n"]
+        assert calls == ["The Eye.\n", "Eye the\n", "New word\n"]
+        main.word_cache.close()
+
+
+class TestResultCache:
+    def test_batch_reuses_results(self, tmp_path, fake_flite, monkeypatch):
+        import main
+        calls = []
+        record_flite_calls(monkeypatch, calls)
+        monkeypatch.setattr(main, "result_cache", main.ResultCache(str(tmp_path / "results.sqlite")))
+        first = batch(["Next Chapter\n", "Next Chapter\n"])
+        second = batch(["Next Chapter\n", "Other\n"])
+        assert first[0] == first[1] == ("Next Chapter\n", "next chapter\n\n")
+        assert second[0] == first[0]
+        assert calls == ["Next Chapter\n", "Other\n"]
+        assert main.result_cache.stats()["hits"] == 1
+        main.result_cache.close()
+
+    def test_rule_change_invalidates(self, tmp_path, monkeypatch):
+        import main
+        path = str(tmp_path / "results.sqlite")
+        cache = main.ResultCache(path)
+        cache.put_many([("text\n", "ipa\n")])
+        assert cache.get_many(["text\n"]) == {"text\n": "ipa\n"}
+        cache.close()
+        monkeypatch.setitem(main.normal_reductions, "new", "nu")
+        cache = main.ResultCache(path)
+        assert cache.get_many(["text\n"]) == {}
+        cache.close()
+
+    def test_setups_sharing_a_file_keep_their_entries(self, tmp_path, monkeypatch):
+        import main
+        path = str(tmp_path / "results.sqlite")
+        old_rules = main.ResultCache(path)
+        old_rules.put_many([("text\n", "old\n")])
+        old_rules.flush()
+        monkeypatch.setitem(main.normal_reductions, "new", "nu")
+        new_rules = main.ResultCache(path)
+        new_rules.put_many([("text\n", "new\n")])
+        new_rules.flush()
+        assert old_rules.get_many(["text\n"]) == {"text\n": "old\n"}
+        assert new_rules.get_many(["text\n"]) == {"text\n": "new\n"}
+        assert new_rules.prune() == 1
+        assert old_rules.get_many(["text\n"]) == {}
+        old_rules.close()
+        new_rules.close()
+
+
+class TestVocabularyPrepass:
+    LINES = ["“The Eye of the World,” he said.\n", "\n", "The eye was\n", "closed at 12.\n", "Mr. Eye left the World.\n"]
+
+    def _run_print_ipa(self, tmp_path, vocab_prepass):
+        import main
+        out_path = tmp_path / f"out_{vocab_prepass}.txt"
+        with open(out_path, "w") as out_file:
+            main.print_ipa(out_file, self.LINES, vocab_prepass=vocab_prepass)
+        return out_path.read_text()
+
+    def test_output_identical_to_per_line(self, tmp_path, fake_flite):
+        assert self._run_print_ipa(tmp_path, True) == self._run_print_ipa(tmp_path, False)
+
+    def test_flite_called_per_word_list_and_context_lines(self, tmp_path, fake_flite, monkeypatch):
+        import main
+        calls = []
+        record_flite_calls(monkeypatch, calls)
+        self._run_print_ipa(tmp_path, True)
+        assert calls[0] == "at closed eye he left of said was world\n"
+        # "the" is pronounced by the word after it, in a probe
+        assert calls[1] == "the eye the cat the\n"
+        # the pronunciations are checked in one call, the lines with a number or an abbreviation run flite on their own
+        assert calls[2:] == ['"The Eye of the World," he said.\n\nThe eye was\n', "The eye was closed at 12.\n", "Mr. Eye left the World.\n"]
+
+    def test_words_checked_with_the_words_around_them(self, monkeypatch):
+        import main
+        calls = []
+        stub_flite(monkeypatch, lambda text: calls.append(text) or flite_ipa(text))
+        monkeypatch.setattr(main, "VOCAB_CHECK_CONTEXT", 1)
+        lexicon = main.build_vocabulary_lexicon(["one two three four five\n", "six one two three four five seven\n"])
+        assert len(lexicon) == 7
+        # only "six" and "seven" are new in the second line
+        assert calls[1:] == ["one two three four five\n\nsix one\n\nfive seven\n"]
+
+    def test_words_read_differently_in_a_sentence_are_dropped(self, monkeypatch):
+        import main
+        # "cat" said in the word list reads "kæt", in the sentence "kat"
+        stub_flite(monkeypatch, lambda text: flite_ipa(text).replace("cat", "kat" if "dog and cat" in text else "kæt"))
+        lexicon = main.build_vocabulary_lexicon(["the dog\n", "dog and cat\n"])
+        assert lexicon["dog"] == "dog" and lexicon["the C"] == "the"
+        assert "cat" not in lexicon and "and" not in lexicon
+        assert main.document_state.vocab_lexicon is None
+
+    def test_phonemize_words_splits_bad_chunks(self, monkeypatch):
+        import main
+        stub_flite(monkeypatch, lambda text: " ".join("x y" if w == "two" else w for w in text.split()) + "\n")
+        assert main._phonemize_words(["one", "two", "three", "four"]) == {"one": "one", "three": "three", "four": "four"}
+
+    def test_mismatching_lexicon_is_dropped(self, monkeypatch):
+        import main
+        stub_flite(monkeypatch, lambda text: text.upper())
+        assert main.build_vocabulary_lexicon(["one eye\n"]) == {}
+
+
+class TestFliteDriver:
+    def test_map_ordered_keeps_order(self, monkeypatch):
+        import random
+        import time
+        import main
+
+        def slow_flite(text):
+            time.sleep(random.random() / 100)
+            return text.upper()
+        stub_flite(monkeypatch, slow_flite)
+        texts = [f"line {i}" for i in range(50)]
+        assert list(main._get_flite_driver().map_ordered(texts, window=8)) == [t.upper() for t in texts]
+
+    def test_reader_is_held_back(self, monkeypatch):
+        import main
+        stub_flite(monkeypatch, lambda text: text)
+        read = []
+
+        def reader():
+            for i in range(100):
+                read.append(i)
+                yield str(i)
+        results = main._get_flite_driver().map_ordered(reader(), window=4)
+        assert next(results) == "0"
+        assert len(read) <= 4
+        assert list(results) == [str(i) for i in range(1, 100)]
+
+    def test_flite_runs_async(self, fake_flite):
+        import main
+        assert list(main._get_flite_driver().map_ordered(["Hello There\n", "Bye"])) == ["hello there\n\n", "bye\n"]
+
+    def test_expensive_texts_dispatched_first(self, monkeypatch):
+        import threading
+        import main
+        started = []
+        release = threading.Event()
+
+        def flite(text):
+            started.append(text)
+            if text == "blocker":
+                release.wait(5)
+            return text
+        stub_flite(monkeypatch, flite)
+        driver = main.FliteDriver(max_in_flight=1)
+        try:
+            first = driver.submit("blocker")
+            while not started:
+                time.sleep(0.001)
+            texts = ["short", "a much longer text with many words in it", "medium text here", "x"]
+            futures = [driver.submit(text) for text in texts]
+            release.set()
+            assert [future.result() for future in futures] == texts
+            assert first.result() == "blocker"
+            assert started[1:] == sorted(texts, key=main._flite_cost, reverse=True)
+            stats = driver.stats()
+            assert stats["calls"] == 5
+            assert 0 < stats["utilisation"] <= 1.0
+        finally:
+            driver.close()
+
+    def test_short_text_runs_once_a_window_was_submitted_after_it(self, monkeypatch):
+        import threading
+        import main
+        started = []
+        release = threading.Event()
+
+        def flite(text):
+            started.append(text)
+            if text == "blocker":
+                release.wait(5)
+            return text
+        stub_flite(monkeypatch, flite)
+        monkeypatch.setattr(main, "FLITE_BATCH_SIZE", 2)
+        monkeypatch.setattr(main, "adaptive_window", None)
+        driver = main.FliteDriver(max_in_flight=1)
+        try:
+            first = driver.submit("blocker")
+            while not started:
+                time.sleep(0.001)
+            texts = ["x", "a long line of many words", "another long line of words", "yet another long line here"]
+            futures = [driver.submit(text) for text in texts]
+            release.set()
+            assert [future.result() for future in futures] == texts
+            assert first.result() == "blocker"
+            # three texts came after "x", more than the window of two, so it no longer waits behind longer ones
+            assert started[1] == "x"
+        finally:
+            driver.close()
+
+
+class TestPrintIpaStreaming:
+    LINES = ["PROLOGUE\n", "Dragonmount\n", "\n", "The palace still shook\n", "occasionally.\n", "\n", "\n",
+             "CHAPTER\n", "1\n", "An Empty Road\n", "\n"] + [f"Line number {i} of the book.\n" for i in range(40)]
+
+    def test_checkpoints_resume_to_identical_output(self, tmp_path, monkeypatch):
+        import main
+        stub_flite(monkeypatch, lambda text: text.upper())
+        monkeypatch.setattr(main, "FLITE_BATCH_SIZE", 4)
+        checkpoints = []
+        real_save = main.save_checkpoint
+        monkeypatch.setattr(main, "save_checkpoint", lambda path, data: checkpoints.append(dict(data)) or real_save(path, data))
+
+        full_path = tmp_path / "full.txt"
+        with open(full_path, "w") as out_file:
+            main.print_ipa(out_file, self.LINES, checkpoint_path=str(tmp_path / "cp"))
+        full = full_path.read_text()
+        assert len(checkpoints) > 3
+
+        for checkpoint in checkpoints[:-1]:
+            resumed_path = tmp_path / "resumed.txt"
+            resumed_path.write_text(full)
+            with open(resumed_path, "r+b") as f:
+                f.truncate(checkpoint["output_bytes"])
+            with open(resumed_path, "a") as out_file:
+                main.print_ipa(out_file, self.LINES, start_line=checkpoint["lines_processed"], joiner=main.LineJoiner.restore(checkpoint))
+            assert resumed_path.read_text() == full
+
+    def test_output_not_held_back_by_slow_line(self, monkeypatch):
+        import threading
+        import main
+        release = threading.Event()
+
+        def flite(text):
+            if "slow" in text:
+                release.wait(5)
+            return text.upper()
+        stub_flite(monkeypatch, flite)
+        lines = ["first line.\n", "second line.\n", "slow line.\n", "last line.\n"]
+        results = main._transcribe_stream(((line, None) for line in lines), window=8)
+        assert next(results)[0] == "first line.\n"
+        assert next(results)[0] == "second line.\n"
+        release.set()
+        assert [text for text, _, _ in results] == lines[2:]
+
+
+    def test_documents_in_parallel_threads(self, monkeypatch):
+        import io
+        import threading
+        import main
+        stub_flite(monkeypatch, lambda text: text.upper())
+        documents = [self.LINES, [line.replace("Line", "Row") for line in reversed(self.LINES)]]
+
+        def run(lines):
+            out_file = io.StringIO()
+            main.print_ipa(out_file, lines)
+            return out_file.getvalue()
+        serial = [run(lines) for lines in documents]
+        parallel = [None, None]
+        threads = [threading.Thread(target=lambda i=i: parallel.__setitem__(i, run(documents[i]))) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert parallel == serial
+
+    def test_reads_lines_as_it_writes(self, monkeypatch):
+        import io
+        import main
+        stub_flite(monkeypatch, lambda text: text.upper())
+        monkeypatch.setattr(main, "FLITE_BATCH_SIZE", 4)
+        read = []
+
+        def lines():
+            for i in range(1000):
+                read.append(i)
+                yield f"Line {i}.\n"
+
+        class Output(io.StringIO):
+            lines_read_at_first_write = None
+
+            def write(self, text):
+                if self.lines_read_at_first_write is None:
+                    self.lines_read_at_first_write = len(read)
+                return super().write(text)
+        out_file = Output()
+        main.print_ipa(out_file, lines(), fix_line_ends=False)
+        assert len(read) == 1000
+        assert out_file.lines_read_at_first_write <= 8
+        assert out_file.getvalue().count("\n") == 2000
+
+    def test_dash_reads_stdin(self, tmp_path, monkeypatch):
+        import io
+        import sys
+        import main
+        stub_flite(monkeypatch, lambda text: text.upper())
+        # main() sets these from its flags
+        for name in ("verb_backend", "nltk_offline", "adaptive_window", "FLITE_MAX_WORKERS", "FLITE_BATCH_SIZE"):
+            monkeypatch.setattr(main, name, getattr(main, name))
+        monkeypatch.setattr(sys, "stdin", io.StringIO("The first line.\nThe second line.\n"))
+        monkeypatch.setattr(sys, "argv", ["main.py", "-", "-o", str(tmp_path / "out.txt")])
+        main.main()
+        assert (tmp_path / "out.txt").read_text() == "THE FIRST LINE.\nThe first line.\nTHE SECOND LINE.\nThe second line.\n"
+
+
+class TestJobs:
+    def test_cgroup_quota_caps_cpus(self, monkeypatch):
+        import builtins
+        import io
+        import main
+        real_open = builtins.open
+
+        def fake_open(path, *args, **kwargs):
+            if path == "/sys/fs/cgroup/cpu.max":
+                return io.StringIO("150000 100000\n")
+            return real_open(path, *args, **kwargs)
+        monkeypatch.setattr(builtins, "open", fake_open)
+        monkeypatch.setattr(main.os, "sched_getaffinity", lambda pid: set(range(16)), raising=False)
+        assert main._available_cpus() == 2
+
+    def test_unlimited_quota_uses_affinity(self, monkeypatch):
+        import builtins
+        import io
+        import main
+        real_open = builtins.open
+
+        def fake_open(path, *args, **kwargs):
+            if path == "/sys/fs/cgroup/cpu.max":
+                return io.StringIO("max 100000\n")
+            return real_open(path, *args, **kwargs)
+        monkeypatch.setattr(builtins, "open", fake_open)
+        monkeypatch.setattr(main.os, "sched_getaffinity", lambda pid: {0, 1, 2}, raising=False)
+        assert main._available_cpus() == 3
+
+    def test_window_grows_with_latency_spread(self):
+        import main
+        window = main.AdaptiveWindow(jobs=4, start=4)
+        for _ in range(50):
+            window.observe(0.01, queue_depth=0)
+        steady = window.size
+        window.observe(0.5, queue_depth=0)
+        for _ in range(50):
+            window.observe(0.01, queue_depth=0)
+        assert window.size > steady
+        assert window.size <= 4 * main.AdaptiveWindow.MAX_PER_JOB
+
+    def test_window_does_not_grow_while_queued(self):
+        import main
+        window = main.AdaptiveWindow(jobs=4, start=4)
+        window.observe(0.01, queue_depth=10)
+        window.observe(0.5, queue_depth=10)
+        assert window.size == 4
+
+
+class TestDirectoryMode:
+    BOOKS = {"short.txt": 3, "long.txt": 40, "middle.txt": 12}
+
+    @pytest.fixture
+    def books(self, tmp_path, monkeypatch):
+        stub_flite(monkeypatch, lambda text: text.upper())
+        (tmp_path / "in").mkdir()
+        (tmp_path / "out").mkdir()
+        for name, count in self.BOOKS.items():
+            (tmp_path / "in" / name).write_text("".join(f"{name} line {i}.\n" for i in range(count)))
+        return tmp_path
+
+    def test_books_in_parallel_match_serial(self, books):
+        import io
+        import main
+        main._transcribe_directory(str(books / "in"), str(books / "out"), at_once=3)
+        for name in self.BOOKS:
+            expected = io.StringIO()
+            with open(books / "in" / name) as f:
+                main.print_ipa(expected, f)
+            assert (books / "out" / f"ipa_{name}").read_text() == expected.getvalue()
+        assert main.open_documents == 0
+        assert not os.path.exists(main.get_checkpoint_path(str(books / "out")))
+
+    def test_largest_first_and_resume_skips_completed(self, books, monkeypatch):
+        import main
+        started = []
+        real_transcribe_file = main._transcribe_file
+        monkeypatch.setattr(main, "_transcribe_file", lambda path, *rest: started.append(os.path.basename(path)) or real_transcribe_file(path, *rest))
+        main.save_checkpoint(main.get_checkpoint_path(str(books / "out")), {"completed_files": [str(books / "in" / "middle.txt")]})
+        main._transcribe_directory(str(books / "in"), str(books / "out"), resume=True, at_once=1)
+        assert started == ["long.txt", "short.txt"]
+        assert not (books / "out" / "ipa_middle.txt").exists()
+
+    def test_same_name_in_subdirectories(self, books):
+        import main
+        for folder in ("book1", "book2"):
+            (books / "in" / folder).mkdir()
+            (books / "in" / folder / "chapter.txt").write_text(f"{folder} text.\n")
+        main._transcribe_directory(str(books / "in"), str(books / "out"), at_once=2)
+        assert (books / "out" / "book1" / "ipa_chapter.txt").read_text() == "BOOK1 TEXT.\nbook1 text.\n"
+        assert (books / "out" / "book2" / "ipa_chapter.txt").read_text() == "BOOK2 TEXT.\nbook2 text.\n"
+        assert (books / "out" / "ipa_short.txt").exists()
+
+
+class TestChapterShards:
+    LINES = ["PROLOGUE\n", "Dragonmount\n", "\n", "The palace still shook\n", "occasionally.\n", "\n", "\n"] + [
+        line for chapter in range(1, 6) for line in
+        ["CHAPTER\n", f"{chapter}\n", "An Empty Road\n", "\n"] + [f"Line {i} of chapter {chapter}, which\n" if i % 3 == 0 else f"Line {i}.\n" for i in range(12)] + ["\n"]
+    ] + ["EPILOGUE\n", "The end\n"]
+
+    def test_shards_start_at_headings(self):
+        import main
+        shards = list(main.chapter_shards(self.LINES))
+        assert len(shards) == 7
+        assert [shard[0].split()[0] for shard in shards[1:]] == ["CHAPTER"] * 5 + ["EPILOGUE"]
+        assert shards[-1] == ["\nEPILOGUE The end\n\n"]
+
+    def test_long_chapters_are_split(self, monkeypatch):
+        import main
+        monkeypatch.setattr(main, "CHAPTER_SHARD_MAX_CHARS", 100)
+        shards = list(main.chapter_shards(self.LINES))
+        assert len(shards) > 7
+        assert [text for shard in shards for text in shard] == [text for shard in main.chapter_shards(self.LINES) for text in shard]
+
+    def test_worker_processes_match_print_ipa(self, tmp_path, monkeypatch):
+        import io
+        import multiprocessing
+        import main
+        stub_flite(monkeypatch, lambda text: text.upper())
+        expected = io.StringIO()
+        main.print_ipa(expected, self.LINES)
+        checkpoints = []
+        monkeypatch.setattr(main, "save_checkpoint", lambda path, data: checkpoints.append(data))
+        # fork so the workers get the stubbed flite
+        with main.ProcessPoolExecutor(2, mp_context=multiprocessing.get_context("fork")) as executor:
+            with open(tmp_path / "out.txt", "w") as out_file:
+                main.print_ipa_sharded(out_file, iter(self.LINES), executor, 3, checkpoint_path="cp")
+            assert (tmp_path / "out.txt").read_text() == expected.getvalue()
+            assert [checkpoint["shards_processed"] for checkpoint in checkpoints] == list(range(1, 8))
+
+            resumed = tmp_path / "resumed.txt"
+            resumed.write_bytes(expected.getvalue().encode()[:checkpoints[3]["output_bytes"]])
+            with open(resumed, "a") as out_file:
+                main.print_ipa_sharded(out_file, self.LINES, executor, 3, start_shard=4)
+            assert resumed.read_text() == expected.getvalue()
+
+
+def _worker_state():
+    import main
+    return main._improved_matcher_cache is not None, main.rule_executor is not None
+
+
+class TestRuleProcesses:
+    TEXTS = [f"So do you want {i} of the family's things\n" if i % 4 else "\n" for i in range(23)]
+
+    @pytest.fixture
+    def executor(self, monkeypatch):
+        import multiprocessing
+        import main
+        stub_flite(monkeypatch, flite_ipa)
+        monkeypatch.setattr(main, "rule_stats", main.Counter())
+        monkeypatch.setattr(main, "RULE_CHUNK_TEXTS", 5)
+        # fork so the workers get the stubbed flite
+        with main.ProcessPoolExecutor(2, mp_context=multiprocessing.get_context("fork"), initializer=main._init_worker,
+                                      initargs=(main.worker_settings([], [], 2),)) as executor:
+            yield executor
+
+    def test_same_results_and_stats_as_in_process(self, executor, monkeypatch):
+        import main
+        expected = [(text, ipa) for text, ipa, _ in main._transcribe_stream(((text, None) for text in self.TEXTS), markers=True)]
+        expected_stats = main.rule_stats.copy()
+        main.rule_stats.clear()
+        monkeypatch.setattr(main, "rule_executor", executor)
+        monkeypatch.setattr(main, "rule_processes", 2)
+        assert [(text, ipa) for text, ipa, _ in main._transcribe_stream(((text, None) for text in self.TEXTS), markers=True)] == expected
+        assert main.rule_stats == expected_stats
+        assert expected_stats["double:do you"] == 17
+
+    def test_workers_are_preloaded(self, executor, monkeypatch):
+        import main
+        # forked after this, so only the initializer can have built it
+        monkeypatch.setattr(main, "_improved_matcher_cache", None)
+        monkeypatch.setattr(main, "rule_executor", executor)
+        assert executor.submit(_worker_state).result() == (True, False)
+
+    def test_workers_started_up_front(self):
+        import multiprocessing
+        import main
+        before = set(multiprocessing.active_children())
+        executor = main.start_rule_workers(2, main.worker_settings([], [], 2))
+        try:
+            assert len(set(multiprocessing.active_children()) - before) == 2
+        finally:
+            executor.shutdown()
+
+
+class TestFliteChunking:
+    LONG_TEXT = ("It was a dark night. " * 30 + "And then, without any warning at all, the door opened! \"Who is there?\" she asked.  ") * 3
+
+    def test_chunks_keep_words(self):
+        import main
+        chunks = main._split_long_text(self.LONG_TEXT, max_chars=200)
+        assert len(chunks) > 1
+        assert all(len(chunk) <= 200 for chunk in chunks)
+        assert " ".join(chunks).split() == self.LONG_TEXT.split()
+        assert all(chunk.endswith((".", "!", "?", "\"")) for chunk in chunks)
+
+    def test_sentence_longer_than_limit_split_at_spaces(self):
+        import main
+        text = "word " * 100 + "end.\n"
+        chunks = main._split_long_text(text, max_chars=50)
+        assert all(len(chunk) <= 50 for chunk in chunks)
+        assert " ".join(chunks).split() == text.split()
+
+    def test_long_sentence_split_at_clauses(self):
+        import main
+        text = "He ran down the road, past the old mill; then he stopped at the gate and waited.\n"
+        assert main._split_long_text(text, max_chars=40) == ["He ran down the road, past the old mill;", "then he stopped at the gate and waited."]
+
+    def test_never_cut_after_a_word_read_by_the_next(self):
+        import main
+        text = " ".join(["walk to the end of a road"] * 20) + ".\n"
+        chunks = main._split_long_text(text, max_chars=30)
+        assert " ".join(chunks).split() == text.split()
+        assert not any(chunk.split()[-1] in main.next_sound_words for chunk in chunks)
+
+    def test_chunking_is_part_of_the_rules_fingerprint(self, monkeypatch):
+        import main
+        before = main._rules_fingerprint()
+        monkeypatch.setattr(main, "FLITE_CHUNK_CHARS", 500)
+        assert main._rules_fingerprint() != before
+
+    def test_short_text_untouched(self):
+        import main
+        assert main._split_long_text("short line.\n") == ["short line.\n"]
+
+    def test_stitched_output_matches_one_call(self, monkeypatch):
+        import main
+        calls = []
+
+        def flite(text):
+            calls.append(text)
+            return flite_ipa(text)
+        stub_flite(monkeypatch, flite)
+        monkeypatch.setattr(main, "FLITE_CHUNK_CHARS", 200)
+        text = self.LONG_TEXT + "\n"
+        assert main._get_flite_driver().submit(text).result() == flite(text)
+        assert len(calls) > 2 and all(len(call) <= 200 for call in calls[:-1])
+
+
+class TestFusedRules:
+    @staticmethod
+    def chain(ipa_text, text):
+        import main
+        ipa_text = main.add_reductions_with_stress(ipa_text, text)
+        ipa_text = main.add_double_word_reductions(ipa_text, text)
+        return main.handle_t_d(ipa_text).replace("ˈ", "")
+
+    @staticmethod
+    def random_line(rng):
+        import main
+        words = (list(main.normal_reductions) + list(main.h_reduction) + ["do", "you", "will", "not", "have", "going", "to",
+                 "could", "should", "i", "am", "want", "kind", "of", "let", "me", "Do", "walk", "", "Want"] +
+                 [pair.split(" ")[0] for pair in main.double_word_reductions])
+        ipa_words = (["ʌv", "ðə", "ɹænd", "mæt", "", "\n", "ˈtɑp", "bʌtə", "wɪntli", "tɹip", "djuk", "hænd", "ɪntu"] +
+                     list(main.improved_pronounciations))
+        letters = main.ipa_letters + "ˈtdtdtdɹj,.!"
+        n = rng.randint(1, 12)
+        text = " ".join(rng.choice(words) for _ in range(n))
+        ipa = []
+        for _ in range(n):
+            if rng.random() < 0.3:
+                ipa.append(rng.choice(ipa_words))
+            else:
+                ipa.append("".join(rng.choice(letters) for _ in range(rng.randint(1, 8))))
+        ipa[-1] += rng.choice(["", "\n", " \n"])
+        return " ".join(ipa), text
+
+    def test_matches_chain(self, monkeypatch):
+        import random
+        import main
+        # the tagger needs NLTK data, and only its answer matters here
+        monkeypatch.setattr(main, "is_verb_in_sentence", lambda word, sentence: len(word) % 2 == 0)
+        rng = random.Random(1234)
+        compared = 0
+        for _ in range(20000):
+            ipa, text = self.random_line(rng)
+            fused = main.apply_rules_fused(ipa, text)
+            if fused is None:
+                continue
+            compared += 1
+            assert fused == self.chain(ipa, text), (ipa, text)
+        assert compared > 10000
+
+    def test_known_lines(self):
+        import main
+        cases = [("ðə kæt ʌv ðə ˈhaʊs\n", "the cat of the house"), ("aɪ æm ˈhɪɹ", "I am here"),
+                 ("dʊ ju ˈwɔk tɛn maɪlz ænd ˈbæk", "do you walk ten miles and back"), ("ɹænd ˈbʌtɝ", "Rand butter")]
+        for ipa, text in cases:
+            assert main.apply_rules_fused(ipa, text) == self.chain(ipa, text)
+
+    def test_falls_back_when_words_do_not_line_up(self):
+        import main
+        assert main.apply_rules_fused("wʌn tu θɹi", "123") is None
+        assert main._apply_rules("wʌn tu θɹi", "123 go on") == self.chain("wʌn tu θɹi", "123 go on")
+
+
+class TestAhoCorasick:
+    @staticmethod
+    def naive(rewrites, word):
+        for orig, changed in rewrites.items():
+            if orig in word.strip():
+                return word.replace(orig, changed)
+        return word
+
+    def test_first_rewrite_in_table_order_wins(self):
+        import main
+        rewrites = {"bcd": "X", "ab": "Y", "abcde": "Z", "c": "W"}
+        matcher = main.AhoCorasick(rewrites)
+        words = "abcde ab xc zzz bcd"
+        assert [matcher.rewrite(word, index) for word, index in zip(words.split(" "), matcher.first_matches(words))] == \
+            [self.naive(rewrites, word) for word in words.split(" ")]
+
+    def test_matches_naive_loop_on_large_table(self):
+        import random
+        import main
+        rng = random.Random(7)
+        alphabet = "abcdeɹˈ"
+        rewrites = {}
+        while len(rewrites) < 5000:
+            rewrites["".join(rng.choice(alphabet) for _ in range(rng.randint(1, 7)))] = str(len(rewrites))
+        matcher = main.AhoCorasick(rewrites)
+        for _ in range(500):
+            words = ["".join(rng.choice(alphabet) for _ in range(rng.randint(0, 10))) for _ in range(rng.randint(1, 6))]
+            words[-1] += "\n"
+            line = " ".join(words)
+            assert [matcher.rewrite(word, index) for word, index in zip(words, matcher.first_matches(line))] == \
+                [self.naive(rewrites, word) for word in words]
+
+    def test_matcher_follows_table_changes(self, monkeypatch):
+        import main
+        monkeypatch.setitem(main.improved_pronounciations, "zzq", "q")
+        assert main.add_reductions_with_stress("azzqb", "word") == "aqb"
+
+    def test_matcher_follows_changed_entries(self, monkeypatch):
+        import main
+        assert main.add_reductions_with_stress("fæməli", "family") == "fæmli"
+        monkeypatch.setitem(main.improved_pronounciations, "fæməli", "XX")
+        assert main.add_reductions_with_stress("fæməli", "family") == "XX"
+        monkeypatch.setattr(main, "improved_pronounciations", {"fæməli": "YY"})
+        assert main.add_reductions_with_stress("fæməli", "family") == "YY"
+        main.improved_pronounciations["fæməli"] = "ZZ"
+        assert main.add_reductions_with_stress("fæməli", "family") == "ZZ"
+
+
+class TestHandleTDBatch:
+    @staticmethod
+    def random_lines(seed, count):
+        import random
+        import main
+        rng = random.Random(seed)
+        letters = main.ipa_letters + "ˈtdtdtdɹjnnn\n,."
+        special = ["ɹænd", "ɹændz", "mæt", "", "ənt", "ɹændt"]
+        lines = []
+        for _ in range(count):
+            words = [rng.choice(special) if rng.random() < 0.15 else "".join(rng.choice(letters) for _ in range(rng.randint(1, 8)))
+                     for _ in range(rng.randint(1, 15))]
+            lines.append(" ".join(words) + rng.choice(["", "\n", " \n", " "]))
+        return lines
+
+    def test_vectorized_matches_handle_t_d(self):
+        pytest.importorskip("numpy")
+        import main
+        main._numpy()
+        for seed in range(50):
+            lines = self.random_lines(seed, 200)
+            assert main._handle_t_d_numpy(lines) == [main.handle_t_d(line) for line in lines]
+
+    def test_batch_without_numpy(self, monkeypatch):
+        import main
+        monkeypatch.setattr(main, "_numpy", lambda: None)
+        lines = self.random_lines(1, 100)
+        assert main.handle_t_d_batch(lines) == [main.handle_t_d(line) for line in lines]
+
+    def test_apply_rules_batch_matches_per_line(self, monkeypatch):
+        import main
+        monkeypatch.setattr(main, "is_verb_in_sentence", lambda word, sentence: False)
+        pairs = [("ðə kæt ʌv ðə ˈhaʊs\n", "the cat of the house"), ("aɪ æm ˈhɪɹ", "I am here"),
+                 ("dʊ ju ˈwɔk tɛn maɪlz ænd ˈbæk", "do you walk ten miles and back"), ("ɹænd ˈbʌtɝ", "Rand butter")] * 40
+        assert main._apply_rules_batch(pairs) == [main._apply_rules(ipa, text) for ipa, text in pairs]
+
+
+class TestPosTagBatching:
+    @pytest.fixture
+    def fake_tagger(self, monkeypatch):
+        import main
+        calls = []
+
+        def pos_tag_sents(sentences):
+            calls.append(len(sentences))
+            return [[(token, "VB" if token in ("go", "be") else "NN") for token in tokens] for tokens in sentences]
+        monkeypatch.setattr(main, "verb_backend", "nltk")
+        monkeypatch.setattr(main, "_pos_tags", {})
+        monkeypatch.setattr(main, "pos_tag_sents", pos_tag_sents)
+        monkeypatch.setattr(main, "word_tokenize", lambda sentence: sentence.split())
+        return calls
+
+    def test_sentence_tagged_once(self, fake_tagger):
+        import main
+        sentence = "I could have go there and would have be here"
+        assert main.is_verb_in_sentence("go", sentence)
+        assert main.is_verb_in_sentence("be", sentence)
+        assert not main.is_verb_in_sentence("there", sentence)
+        assert fake_tagger == [1]
+
+    def test_batch_tags_only_candidates(self, fake_tagger):
+        import main
+        pairs = [("aɪ kʊd hæv goʊ\n", "I could have go\n"), ("ðə kæt sæt", "the cat sat"),
+                 ("ʃi ʃʊd hæv bi hɪɹ", "she should have be here"), ("aɪ kʊd hæv goʊ\n", "I could have go\n")]
+        results = main._apply_rules_batch(pairs)
+        assert fake_tagger == [2]
+        assert results == [main._apply_rules(ipa, text) for ipa, text in pairs]
+        assert fake_tagger == [2]
+
+    def test_tags_returned_even_when_memo_cleared(self, fake_tagger, monkeypatch):
+        import main
+        monkeypatch.setattr(main, "POS_TAG_CACHE_SIZE", 1)
+        first, second = "I could have go", "she should have be here"
+        assert main.tag_sentences([first, second]) == {first: [("I", "NN"), ("could", "NN"), ("have", "NN"), ("go", "VB")],
+                                                       second: [("she", "NN"), ("should", "NN"), ("have", "NN"),
+                                                                ("be", "VB"), ("here", "NN")]}
+        main._pos_tags.clear()
+        assert main.is_verb_in_sentence("go", first)
+
+    def test_verb_candidates(self):
+        import main
+        assert main.verb_candidates("we are going to win") == ["win"]
+        assert main.verb_candidates("we are going to") == []
+        assert main.verb_candidates("you could have not") == []
+        assert main.verb_candidates("nothing to see here") == []
+
+
+class TestStartup:
+    # seconds for a fresh "import main", with room for slow CI machines
+    IMPORT_TIME_BUDGET = 1.0
+
+    def test_import_is_fast_and_lazy(self):
+        import subprocess
+        import sys
+        code = ("import sys, time; start = time.perf_counter(); import main; took = time.perf_counter() - start; "
+                "print(took, 'nltk' in sys.modules, 'numpy' in sys.modules)")
+        out = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)), text=True)
+        took, nltk_loaded, numpy_loaded = out.split()
+        assert nltk_loaded == "False" and numpy_loaded == "False"
+        assert float(took) < self.IMPORT_TIME_BUDGET
+
+    def test_offline_mode_fails_fast(self, monkeypatch):
+        pytest.importorskip("nltk")
+        import nltk
+        import main
+
+        def no_data(path):
+            raise LookupError(path)
+
+        def no_download(*args, **kwargs):
+            raise AssertionError("offline mode must not download")
+        monkeypatch.setattr(main, "_nltk", None)
+        monkeypatch.setattr(main, "nltk_offline", True)
+        monkeypatch.setattr(nltk.data, "find", no_data)
+        monkeypatch.setattr(nltk, "download", no_download)
+        with pytest.raises(LookupError, match="nltk-offline"):
+            main.word_tokenize("a sentence")
+
+    @pytest.mark.parametrize("version, wanted", [("3.10.3", ["averaged_perceptron_tagger_eng", "punkt_tab"]),
+                                                 ("3.8.1", ["averaged_perceptron_tagger", "punkt"])])
+    def test_data_the_installed_version_loads(self, monkeypatch, version, wanted):
+        pytest.importorskip("nltk")
+        import nltk
+        import main
+        installed = {"taggers/averaged_perceptron_tagger", "tokenizers/punkt"} if version == "3.10.3" else set()
+        downloads = []
+
+        def find(path):
+            if path not in installed:
+                raise LookupError(path)
+        monkeypatch.setattr(main, "_nltk", None)
+        monkeypatch.setattr(nltk, "__version__", version)
+        monkeypatch.setattr(nltk.data, "find", find)
+        monkeypatch.setattr(nltk, "download", lambda name, quiet: downloads.append(name))
+        main._load_nltk()
+        # the legacy data of an old install doesn't count for a version that no longer loads it
+        assert downloads == wanted
+
+
+@pytest.fixture
+def restore_rules(monkeypatch, tmp_path):
+    """Rule pack tests replace the rule tables. Puts them back afterwards, and keeps the compiled rules out of the repo"""
+    import main
+    for name in main.RULE_TABLES + ("_double_word_lookup", "_improved_matcher_cache", "book_words", "t_d_skip_words"):
+        monkeypatch.setattr(main, name, getattr(main, name))
+    monkeypatch.setattr(main, "_rule_cache_dir", str(tmp_path / "rulecache"))
+    return tmp_path
+
+
+class TestRulePacks:
+    def test_packs_layer_in_order(self, restore_rules):
+        import main
+        first = write_pack(restore_rules / "first.json", {"improved_pronounciations": {"kæt": "kat"},
+                                                               "double_word_reductions": {"out of": "aʊɾə"}})
+        second = write_pack(restore_rules / "second.json", {"improved_pronounciations": {"kæt": "kʌt"}})
+        main.use_rule_packs([first, second])
+        assert main.improved_pronounciations["kæt"] == "kʌt"
+        assert "fæməli" in main.improved_pronounciations
+        assert main.add_reductions_with_stress("ðə kæts", "the cats") == "ðə kʌts"
+        assert main.add_double_word_reductions("aʊt ʌv hɪɹ", "out of here") == "aʊɾə hɪɹ"
+
+    def test_compiled_rules_are_cached(self, restore_rules, monkeypatch):
+        import main
+        pack = write_pack(restore_rules / "pack.json", {"improved_pronounciations": {"kæt": "kat"}})
+        main.use_rule_packs([pack])
+        expected = main._improved_matcher().first_matches("ðə kæts hɪɹ")
+        assert len(os.listdir(restore_rules / "rulecache")) == 1
+
+        def no_build(self, rewrites):
+            raise AssertionError("the automaton should come from the cache")
+        monkeypatch.setattr(main.AhoCorasick, "__init__", no_build)
+        main.use_rule_packs([])
+        assert main._improved_matcher().first_matches("ðə kæts hɪɹ") == expected
+
+    def test_workers_compiling_at_once_write_their_own_files(self, restore_rules, monkeypatch):
+        import threading
+        import main
+        # every writer stops half way until all of them started, so their writes overlap
+        barrier = threading.Barrier(4, timeout=5)
+        real_dump = main.marshal.dump
+
+        def slow_dump(value, f):
+            barrier.wait()
+            real_dump(value, f)
+        monkeypatch.setattr(main.marshal, "dump", slow_dump)
+        threads = [threading.Thread(target=main._compile_rules) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        [cache_file] = os.listdir(restore_rules / "rulecache")
+        assert cache_file.endswith(".marshal")
+        monkeypatch.setattr(main.marshal, "dump", real_dump)
+        with open(restore_rules / "rulecache" / cache_file, "rb") as f:
+            lookup, tables = main.marshal.load(f)
+        assert lookup == main._double_word_lookup
+
+    def test_bad_pack(self, restore_rules):
+        import main
+        for pack in ({"reductions": {}}, {"double_word_reductions": {"one": "wʌn"}}, {"h_reduction": {"him": 1}}):
+            with pytest.raises(ValueError):
+                main.load_rule_pack(write_pack(restore_rules / "bad.json", pack))
+
+
+class TestLexiconPacks:
+    def test_words_replace_flite_output(self, restore_rules, monkeypatch):
+        import main
+        stub_flite(monkeypatch, flite_ipa)
+        main.use_lexicon_packs([write_pack(restore_rules / "book.json", {"words": {"Egwene": "ɛˈɡwin"}})])
+        assert batch(["Egwene, come here.\n"]) == [("Egwene, come here.\n", "ɛɡwin, come here.\n\n")]
+
+    def test_known_words_skip_flite(self, restore_rules, monkeypatch):
+        import main
+        calls = []
+
+        def flite(text):
+            calls.append(text)
+            return text
+        stub_flite(monkeypatch, flite)
+        main.use_lexicon_packs([write_pack(restore_rules / "book.json", {"words": {"Rand": "ɹænd", "Mat": "mæt"}})])
+        assert batch(["Rand Mat!\n"]) == [("Rand Mat!\n", "ɹænd mæt!\n\n")]
+        assert calls == []
+
+    def test_all_caps_words_use_the_pack(self, restore_rules, monkeypatch):
+        import main
+        calls = []
+
+        def flite(text):
+            calls.append(text)
+            return text
+        stub_flite(monkeypatch, flite)
+        main.use_lexicon_packs([write_pack(restore_rules / "book.json", {"words": {"Rand": "ɹænd", "Mat": "mæt"}})])
+        assert batch(["RAND MAT!\n"]) == [("RAND MAT!\n", "ɹænd mæt!\n\n")]
+        assert calls == []
+
+    def test_ipa_rewrites_win_over_built_in(self, restore_rules):
+        import main
+        main.use_lexicon_packs([write_pack(restore_rules / "book.json", {"ipa": {"fæm": "fam"}})])
+        assert main.add_reductions_with_stress("fæməli", "family") == "faməli"
+        assert "fæməli" in main.improved_pronounciations
+
+    def test_t_d_skip(self, restore_rules):
+        import main
+        assert main.handle_t_d("pɛɹɪn ˈbʌtɝ") == "pɛɹɪn ˈbʌɾɝ"
+        main.use_lexicon_packs([write_pack(restore_rules / "book.json", {"t_d_skip": ["ˈbʌtɝ"]})])
+        assert main.handle_t_d("pɛɹɪn ˈbʌtɝ") == "pɛɹɪn ˈbʌtɝ"
+        assert main.apply_rules_fused("pɛɹɪn ˈbʌtɝ", "perrin butter") == "pɛɹɪn bʌtɝ"
+
+    def test_bad_pack(self, restore_rules):
+        import main
+        for pack in ({"names": {}}, {"words": {"Aes Sedai": "eɪs sɛdaɪ"}}, {"t_d_skip": [1]}, {"ipa": {"a": ""}}):
+            with pytest.raises(ValueError):
+                main.load_lexicon_pack(write_pack(restore_rules / "bad.json", pack))
+
+
+class TestRuleStats:
+    LINES = [("ðə kæt ʌv ðə ˈhaʊs\n", "the cat of the house"), ("aɪ æm ˈhɪɹ wɪð ˈfæməli", "I am here with family"),
+             ("dʊ ju ˈwɔk tɛn maɪlz ænd ˈbæk", "do you walk ten miles and back"), ("ˈbʌtɝ ˈtɹi", "butter tree")]
+
+    def test_fused_and_chain_count_the_same(self, monkeypatch):
+        import main
+        chain_stats, fused_stats = main.Counter(), main.Counter()
+        monkeypatch.setattr(main, "rule_stats", chain_stats)
+        for ipa, text in self.LINES:
+            TestFusedRules.chain(ipa, text)
+        monkeypatch.setattr(main, "rule_stats", fused_stats)
+        for ipa, text in self.LINES:
+            main.apply_rules_fused(ipa, text)
+        assert chain_stats == fused_stats
+        assert fused_stats["double:do you"] == 1 and fused_stats["double:i am"] == 1
+        assert fused_stats["normal:and"] == 1 and fused_stats["improved:fæməli"] == 1
+        # tɹi, and the dj of the merged "dju"
+        assert fused_stats["flap"] >= 1 and fused_stats["affricate"] == 2
+
+    def test_vectorized_counts_match(self, monkeypatch):
+        pytest.importorskip("numpy")
+        import main
+        lines = TestHandleTDBatch.random_lines(5, 200)
+        per_line, vectorized = main.Counter(), main.Counter()
+        monkeypatch.setattr(main, "rule_stats", per_line)
+        [main.handle_t_d(line) for line in lines]
+        main._numpy()
+        monkeypatch.setattr(main, "rule_stats", vectorized)
+        main._handle_t_d_numpy(lines)
+        assert per_line == vectorized
+
+    def test_written_as_json(self, monkeypatch, tmp_path):
+        import main
+        monkeypatch.setattr(main, "rule_stats", main.Counter())
+        for ipa, text in self.LINES:
+            main._apply_rules(ipa, text)
+        main.write_rule_stats(str(tmp_path / "stats.json"))
+        stats = json.loads((tmp_path / "stats.json").read_text(encoding="utf-8"))
+        assert stats["counts"]["improved:fæməli"] == 1
+        assert "fæməli" not in stats["unused_improved_pronounciations"]
+        assert "kæmɝə" in stats["unused_improved_pronounciations"]
+
+    def test_counts_from_threads_all_land(self, monkeypatch):
+        import main
+        from concurrent.futures import ThreadPoolExecutor
+        monkeypatch.setattr(main, "rule_stats", main.Counter())
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(lambda _: [main._count("flap") for _ in range(10000)], range(4)))
+        assert main.rule_stats == {"flap": 40000}
+
+
+class TestTranscriptionApi:
+    def test_alignment_follows_double_word_reductions(self, monkeypatch):
+        import main
+        stub_flite(monkeypatch, flite_ipa)
+        [plain, merged] = main.transcribe_batch(["the cat sat\n", "So do you want it\n"])
+        assert list(plain.alignment) == [0, 1, 2]
+        assert merged.ipa_tokens[1] == "dʒju"
+        assert list(merged.alignment) == [0, 1, 1, 2, 3]
+        assert len(merged.ipa_tokens) == 4
+
+    def test_no_alignment_when_flite_reads_other_words(self, monkeypatch):
+        import main
+        stub_flite(monkeypatch, lambda text: "ɛtsɛtəɹə\n")
+        transcription = main.transcribe("et cetera\n")
+        assert transcription.alignment is None
+        assert transcription.tokens == ["et", "cetera\n"]
+
+    def test_alignment_is_worked_out_on_first_use(self, monkeypatch):
+        import main
+        plans = []
+        real_plan = main._double_word_plan
+        monkeypatch.setattr(main, "_double_word_plan", lambda *args, **kwargs: plans.append(args) or real_plan(*args, **kwargs))
+        transcription = main.Transcription("do you walk\n", "dʒju wɔk\n")
+        assert plans == []
+        assert list(transcription.alignment) == [0, 0, 1]
+        assert list(transcription.alignment) == [0, 0, 1]
+        assert len(plans) == 1
+
+    def test_every_text_gets_a_transcription(self, monkeypatch):
+        import main
+        stub_flite(monkeypatch, lambda text: text.upper())
+        assert batch(["a\n", "\n"]) == [("a\n", "A\n"), ("\n", "\n")]
+        assert main.run_flite("\n") == ("\n", "\n")
+
+    def test_records_are_slotted(self):
+        import main
+        with pytest.raises(AttributeError):
+            main.Transcription("a", "ə").extra = 1